@@ -0,0 +1,224 @@
+import argparse
+import importlib
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.fake_drive import FakeDrive  # noqa: E402
+from bench.fake_zendesk import FakeZendesk  # noqa: E402
+
+'''
+Throughput benchmarks for the migration hot path, run entirely against bench.fake_drive and bench.fake_zendesk.
+Generates synthetic ticket trees of a given size and shape, migrates them with main.migrate_all and reports items/sec,
+API calls per item and peak memory.
+
+    python -m bench.benchmark                         # 1k, 10k and 100k node trees, every shape
+    python -m bench.benchmark --sizes 1000 --latency 0.01 --json bench_output.txt
+'''
+
+OLD_ROOT = 'OLDCASE'
+DRIVE_ID = 'NEWCASE'
+DOMAIN = 'org.org'
+# (depth, fan-out, files per folder) below each structure folder
+SHAPES = {'wide': (1, 20, 10), 'balanced': (3, 4, 5), 'deep': (8, 1, 2)}
+
+
+def build_ticket_tree(drive: FakeDrive, nodes: int, depth: int, fanout: int, files_per_folder: int,
+                      structure_names: list, external_rate: float = 0.02, seed: int = 0):
+    """
+    Fill OLD_ROOT with ticket folders until there are about `nodes` files and folders in total.
+
+    :return: number of ticket folders created
+    """
+    rng = random.Random(seed)
+    drive.add_folder('Old shared folder', file_id=OLD_ROOT)
+    created, ticket = 0, 0
+    while created < nodes:
+        ticket += 1
+        ticket_id = drive.add_folder(f'Ticket #{ticket} synthetic subject', OLD_ROOT)
+        created += 1
+        for structure_name in rng.sample(structure_names, k=rng.randint(1, len(structure_names))):
+            level = [drive.add_folder(structure_name, ticket_id)]
+            created += 1
+            for current_depth in range(depth + 1):
+                next_level = []
+                for folder_id in level:
+                    for n in range(files_per_folder):
+                        owner = f'someone@{"outside.com" if rng.random() < external_rate else DOMAIN}'
+                        drive.add_file(f'file {n}.pdf', folder_id, owner=owner)
+                        created += 1
+                    if current_depth < depth:
+                        for n in range(fanout):
+                            next_level.append(drive.add_folder(f'folder {current_depth}.{n}', folder_id))
+                            created += 1
+                level = next_level
+    return ticket
+
+
+def build_destination(drive: FakeDrive, container_root: str, tickets: int, per_container: int = 1000):
+    drive.add_shared_drive(DRIVE_ID, members=[DOMAIN])
+    drive.add_folder('Tickets', DRIVE_ID, file_id=container_root)
+    top = drive.add_folder(f'Tickets 1-{max(tickets, per_container)}', container_root)
+    for start in range(1, tickets + 1, per_container):
+        drive.add_folder(f'{start}-{start + per_container - 1}', top)
+
+
+def use_variables_template():
+    """Import variables_template as variables if there's no variables.py; the fakes don't care about the real IDs"""
+    try:
+        importlib.import_module('variables')
+    except ModuleNotFoundError:
+        sys.modules['variables'] = importlib.import_module('variables_template')
+
+
+def use_fakes(drive: FakeDrive, zendesk: FakeZendesk):
+    """
+    Point main at the fakes, with a fresh state store and working directory, and the rate limiters out of the way
+
+    :return: the scratch directory main now works in
+    """
+    import main
+    import throttle
+    import zendesk_service as zd
+    from drive_service import DriveClient
+    from state_store import StateStore
+
+    workdir = tempfile.mkdtemp(prefix='bench-')
+    os.chdir(workdir)
+    main.dc = DriveClient(service=drive)
+    main.state = StateStore(os.path.join(workdir, 'migration.db'))
+    main.containers = main.ContainerIndex()
+    main.STRUCTURE = sorted(set(main.FOLDER_MAP.values()) | {'redacted'})
+    zd.client = zd.ZendeskClient(base_url=zendesk.url)
+    throttle.drive_throttle.set_rate(1e9)  # measure the migrator, not the rate limiter
+    throttle.zendesk_throttle.set_rate(1e9)
+    throttle.copy_throttle.set_rate(1e9)
+    return workdir
+
+
+def run_migration(nodes: int, shape: str, latency: float, workers: int, measure_memory: bool):
+    import main
+
+    depth, fanout, files_per_folder = SHAPES[shape]
+    drive = FakeDrive(latency=latency)
+    structure_names = sorted(main.FOLDER_MAP)
+    tickets = build_ticket_tree(drive, nodes, depth, fanout, files_per_folder, structure_names)
+    build_destination(drive, main.CONTAINER_ROOT, tickets)
+    items = len(drive.items)
+
+    zendesk = FakeZendesk(latency=latency).start()
+    use_fakes(drive, zendesk)
+    main.MIGRATION_WORKERS = workers
+    drive.calls.clear()
+    drive.round_trips = 0
+
+    if measure_memory:
+        tracemalloc.start()
+    start = time.perf_counter()
+    main.migrate_all(folder_id=OLD_ROOT)
+    elapsed = time.perf_counter() - start
+    peak = tracemalloc.get_traced_memory()[1] if measure_memory else None
+    if measure_memory:
+        tracemalloc.stop()
+    zendesk.stop()
+
+    left_behind = sum(1 for item in drive.items.values()
+                      if item.get('parents') and item['parents'][0] == OLD_ROOT)
+    api_calls = sum(count for method, count in drive.calls.items() if method != 'batch')
+    return {'scenario': 'migrate_all', 'shape': shape, 'nodes': items, 'tickets': tickets,
+            'seconds': round(elapsed, 3), 'items_per_sec': round(items / elapsed, 1),
+            'api_calls_per_item': round(api_calls / items, 3),
+            'http_requests_per_item': round(drive.round_trips / items, 3),
+            'zendesk_requests': sum(zendesk.calls.values()),
+            'peak_memory_mb': round(peak / 2 ** 20, 2) if peak is not None else None,
+            'tickets_left_behind': left_behind}
+
+
+def run_moves(nodes: int, latency: float, batched: bool):
+    from drive_service import DriveClient
+    import throttle
+
+    drive = FakeDrive(latency=latency)
+    drive.add_shared_drive(DRIVE_ID, members=[DOMAIN])
+    source = drive.add_folder('source')
+    destination = drive.add_folder('destination', DRIVE_ID)
+    rng = random.Random(0)
+    file_list = [drive.add_file(f'file {n}', source,
+                                owner=f'someone@{"outside.com" if rng.random() < 0.02 else DOMAIN}')
+                 for n in range(nodes)]
+    throttle.drive_throttle.set_rate(1e9)
+    dc = DriveClient(service=drive)
+    drive.calls.clear()
+    drive.round_trips = 0
+    start = time.perf_counter()
+    dc.move_files_location(old_folder=source, new_folder=destination, file_list=file_list, batched=batched)
+    elapsed = time.perf_counter() - start
+    api_calls = sum(count for method, count in drive.calls.items() if method != 'batch')
+    return {'scenario': f'move_files_location (batched={batched})', 'shape': '-', 'nodes': nodes,
+            'seconds': round(elapsed, 3), 'items_per_sec': round(nodes / elapsed, 1),
+            'api_calls_per_item': round(api_calls / nodes, 3),
+            'http_requests_per_item': round(drive.round_trips / nodes, 3)}
+
+
+def run_listing(nodes: int, latency: float):
+    from drive_service import DriveClient
+
+    drive = FakeDrive(latency=latency)
+    folder = drive.add_folder('big folder')
+    for n in range(nodes):
+        drive.add_file(f'file {n}', folder)
+    dc = DriveClient(service=drive)
+    drive.round_trips = 0
+    start = time.perf_counter()
+    listed = sum(1 for _ in dc.iter_files(folder, prefetch=True))
+    elapsed = time.perf_counter() - start
+    return {'scenario': 'iter_files', 'shape': '-', 'nodes': listed, 'seconds': round(elapsed, 3),
+            'items_per_sec': round(listed / elapsed, 1),
+            'http_requests_per_item': round(drive.round_trips / listed, 4)}
+
+
+def print_table(results: list):
+    columns = ['scenario', 'shape', 'nodes', 'seconds', 'items_per_sec', 'api_calls_per_item',
+               'http_requests_per_item', 'peak_memory_mb']
+    widths = {column: max(len(column), *(len(str(r.get(column, ''))) for r in results)) for column in columns}
+    print('  '.join(column.ljust(widths[column]) for column in columns))
+    for result in results:
+        print('  '.join(str(result.get(column, '')).ljust(widths[column]) for column in columns))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the migration hot path against a fake Drive and Zendesk')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--shapes', nargs='+', choices=list(SHAPES), default=list(SHAPES))
+    parser.add_argument('--latency', type=float, default=0.0, help='seconds per fake HTTP round trip')
+    parser.add_argument('--workers', type=int, default=8, help='MIGRATION_WORKERS to run with')
+    parser.add_argument('--no-memory', action='store_true', help="skip tracemalloc, which slows things down")
+    parser.add_argument('--json', help='also write the results to this file')
+    args = parser.parse_args()
+
+    # main.py writes its bookkeeping (and log) into the working directory, so give it a scratch one
+    os.chdir(tempfile.mkdtemp(prefix='bench-'))
+    use_variables_template()
+
+    results = []
+    for size in args.sizes:
+        results.append(run_listing(size, args.latency))
+        for batched in (False, True):
+            results.append(run_moves(size, args.latency, batched))
+        for shape in args.shapes:
+            results.append(run_migration(size, shape, args.latency, args.workers, not args.no_memory))
+    print_table(results)
+    if args.json:
+        with open(os.path.join(REPO_ROOT, args.json), 'w', encoding='utf-8') as outfile:
+            json.dump(results, outfile, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,405 @@
+import hashlib
+import itertools
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+
+import httplib2
+from googleapiclient.errors import HttpError
+
+'''
+An in-process stand-in for the Drive v3 service object that googleapiclient's build() returns, for benchmarking
+DriveClient and main without touching Google. It keeps files in memory and answers files().list/get/create/update/
+copy/delete, permissions().list/update, changes().getStartPageToken/list and batch requests, including paging and
+the errors the migrator handles.
+Pass it to DriveClient(service=FakeDrive(...)).
+'''
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+DEFAULT_FIELDS = ['kind', 'id', 'name', 'mimeType']
+MAX_BATCH_SIZE = 100
+
+
+def http_error(status: int, reason: str, message: str = None):
+    """An HttpError shaped like the ones Drive sends back"""
+    resp = httplib2.Response({'status': status})
+    resp.reason = message or reason
+    content = {'error': {'code': status, 'message': message or reason,
+                         'errors': [{'domain': 'global', 'reason': reason, 'message': message or reason}]}}
+    return HttpError(resp, json.dumps(content).encode('utf-8'))
+
+
+def _field_names(fields: str):
+    """'nextPageToken, files(id, owners(emailAddress))' -> {'nextPageToken': 'files(id, owners(emailAddress))'}"""
+    names, depth, current = {}, 0, ''
+    for char in (fields or '') + ',':
+        if char == ',' and depth == 0:
+            current = current.strip()
+            if current:
+                names[current.split('(')[0].strip()] = current
+            current = ''
+            continue
+        depth += char == '('
+        depth -= char == ')'
+        current += char
+    return names
+
+
+def _file_fields(fields: str):
+    """The per-file fields asked for, either 'files(a, b)' in a list call or 'a, b' in a get call"""
+    names = _field_names(fields)
+    if 'files' in names:
+        inner = names['files']
+        return list(_field_names(inner[inner.index('(') + 1:inner.rindex(')')]))
+    return list(names) or DEFAULT_FIELDS
+
+
+class FakeRequest:
+
+    def __init__(self, drive: 'FakeDrive', method: str, fn, **kwargs):
+        self.drive = drive
+        self.method = method
+        self.methodId = f'drive.{method}'  # what googleapiclient's HttpRequest calls it
+        self.fn = fn
+        self.kwargs = kwargs
+
+    def _run(self):
+        with self.drive.lock:
+            self.drive.calls[self.method] += 1
+        self.drive.maybe_fail(self.method)
+        return self.fn(**self.kwargs)
+
+    def execute(self, http=None, num_retries: int = 0):
+        self.drive.round_trip()
+        return self._run()
+
+
+class FakeBatch:
+
+    def __init__(self, drive: 'FakeDrive', callback=None):
+        self.drive = drive
+        self.callback = callback
+        self.requests = []
+
+    def add(self, request: FakeRequest, callback=None, request_id: str = None):
+        if len(self.requests) >= MAX_BATCH_SIZE:
+            raise ValueError(f'A batch can hold at most {MAX_BATCH_SIZE} requests')
+        self.requests.append((request_id or str(len(self.requests)), request, callback))
+
+    def execute(self, http=None):
+        self.drive.round_trip()
+        with self.drive.lock:
+            self.drive.calls['batch'] += 1
+        for request_id, request, callback in self.requests:
+            try:
+                response, exception = request._run(), None
+            except HttpError as e:
+                response, exception = None, e
+            for cb in (callback, self.callback):
+                if cb:
+                    cb(request_id, response, exception)
+
+
+class FakeResource:
+
+    def __init__(self, drive: 'FakeDrive', prefix: str, methods: dict):
+        self.drive = drive
+        self.prefix = prefix
+        self.methods = methods
+
+    def __getattr__(self, name):
+        fn = self.methods.get(name)
+        if fn is None:
+            raise AttributeError(name)
+        return lambda **kwargs: FakeRequest(self.drive, f'{self.prefix}.{name}', fn, **kwargs)
+
+
+class FakeDrive:
+
+    def __init__(self, latency: float = 0.0, quota_error_rate: float = 0.0, user: str = 'migrator@org.org',
+                 seed: int = 0):
+        """
+        :param latency: seconds every HTTP round trip takes (a batch is one round trip)
+        :param quota_error_rate: chance that any single request fails with 403 userRateLimitExceeded
+        :param user: email address of the account the migrator runs as; owns everything it creates or copies
+        :param seed: seed for the quota error dice
+        """
+        self.latency = latency
+        self.quota_error_rate = quota_error_rate
+        self.user = user
+        self.random = random.Random(seed)
+        self.lock = threading.RLock()
+        self.items: dict[str, dict] = {}
+        self.children: dict[str, dict] = {}  # parent id -> {child id: None}, i.e. an insertion-ordered set
+        self.drives: dict[str, set] = {}  # shared drive root id -> member emails/domains
+        self.calls = Counter()
+        self.round_trips = 0
+        self.injected: dict[str, list] = {}  # method or file id -> [(status, reason), ...] to fail with next
+        self.change_log: list[str] = []  # ids of changed files, oldest first; a page token is an index into it
+        self._ids = itertools.count(1)
+
+    # ---- setting up a tree -------------------------------------------------------------------------------------
+
+    def new_id(self):
+        return f'f{next(self._ids)}'
+
+    def add_file(self, name: str, parent: str = None, mime_type: str = 'text/plain', owner: str = None,
+                 file_id: str = None, **extra):
+        """Put a file straight into the fake, without counting it as an API call. Returns its id."""
+        with self.lock:
+            file_id = file_id or self.new_id()
+            item = {'kind': 'drive#file', 'id': file_id, 'name': name, 'mimeType': mime_type,
+                    'parents': [parent] if parent else [], 'trashed': False, **extra}
+            if mime_type != FOLDER_MIMETYPE:
+                item.setdefault('size', str(len(name) * 1024))
+                item.setdefault('md5Checksum', hashlib.md5(f'{file_id}/{name}'.encode('utf-8')).hexdigest())
+            if not self.drive_of(parent):
+                item['owners'] = [{'emailAddress': owner or self.user}]
+            self.items[file_id] = item
+            if parent:
+                self.children.setdefault(parent, {})[file_id] = None
+            self.change_log.append(file_id)
+            return file_id
+
+    def add_folder(self, name: str, parent: str = None, **kwargs):
+        return self.add_file(name, parent, mime_type=FOLDER_MIMETYPE, **kwargs)
+
+    def add_shared_drive(self, drive_id: str, name: str = 'Shared drive', members: list = None):
+        """:param members: emails, or bare domains like 'org.org', whose files can be moved into this drive"""
+        with self.lock:
+            self.items[drive_id] = {'kind': 'drive#file', 'id': drive_id, 'name': name,
+                                    'mimeType': FOLDER_MIMETYPE, 'parents': [], 'trashed': False}
+            self.drives[drive_id] = set(members or []) | {self.user}
+            return drive_id
+
+    def inject(self, target: str, reason: str, status: int = 403, times: int = 1):
+        """Make the next `times` calls of a method (e.g. 'files.update') or touching a file id fail"""
+        with self.lock:
+            self.injected.setdefault(target, []).extend([(status, reason)] * times)
+
+    # ---- plumbing ----------------------------------------------------------------------------------------------
+
+    def round_trip(self):
+        with self.lock:
+            self.round_trips += 1
+        if self.latency:
+            time.sleep(self.latency)
+
+    def maybe_fail(self, method: str = None, file_id: str = None):
+        """Raise an injected error for this method or file, or (once per request) a random quota error"""
+        with self.lock:
+            for target in (method, file_id):
+                if target and self.injected.get(target):
+                    status, reason = self.injected[target].pop(0)
+                    raise http_error(status, reason)
+            if method and self.quota_error_rate and self.random.random() < self.quota_error_rate:
+                raise http_error(403, 'userRateLimitExceeded', 'User Rate Limit Exceeded')
+
+    def drive_of(self, file_id: str):
+        """Id of the shared drive file_id lives in, or None"""
+        seen = set()
+        while file_id and file_id not in seen:
+            if file_id in self.drives:
+                return file_id
+            seen.add(file_id)
+            item = self.items.get(file_id)
+            file_id = item.get('parents')[0] if item and item.get('parents') else None
+        return None
+
+    def is_member(self, drive_id: str, email: str):
+        members = self.drives.get(drive_id, set())
+        return email in members or email.split('@')[-1] in members
+
+    def _get(self, file_id: str):
+        item = self.items.get(file_id)
+        if item is None:
+            raise http_error(404, 'notFound', f'File not found: {file_id}.')
+        self.maybe_fail(file_id=file_id)
+        return item
+
+    @staticmethod
+    def _project(item: dict, fields: list):
+        return {field: item[field] for field in fields if field in item}
+
+    def _matches(self, item: dict, q: str):
+        for clause in re.split(r'\s+and\s+', q.strip()):
+            clause = clause.strip()
+            if clause.startswith('(') and clause.endswith(')'):
+                clause = clause[1:-1]
+            if not any(self._term(item, term.strip()) for term in re.split(r'\s+or\s+', clause)):
+                return False
+        return True
+
+    @staticmethod
+    def _term(item: dict, term: str):
+        match = re.fullmatch(r"parents\s*=\s*'([^']*)'|'([^']*)'\s+in\s+parents", term)
+        if match:
+            return (match.group(1) or match.group(2)) in item.get('parents', [])
+        match = re.fullmatch(r"mimeType\s*(!?=)\s*'([^']*)'", term)
+        if match:
+            return (item.get('mimeType') == match.group(2)) == (match.group(1) == '=')
+        match = re.fullmatch(r"trashed\s*=\s*(true|false)", term)
+        if match:
+            return item.get('trashed') == (match.group(1) == 'true')
+        raise http_error(400, 'invalid', f'Invalid Value: {term}')
+
+    def _parents_in(self, q: str):
+        return re.findall(r"parents\s*=\s*'([^']*)'|'([^']*)'\s+in\s+parents", q)
+
+    # ---- files() -----------------------------------------------------------------------------------------------
+
+    def _list(self, q: str = '', fields: str = None, pageSize: int = 100, pageToken: str = None, **kwargs):
+        with self.lock:
+            parents = [a or b for a, b in self._parents_in(q)]
+            if parents:
+                candidates = [self.items[child] for parent in parents for child in self.children.get(parent, {})]
+            else:
+                candidates = list(self.items.values())
+            matches = [item for item in candidates if self._matches(item, q)] if q else candidates
+        start = int(pageToken or 0)
+        page_size = min(pageSize or 100, 1000)
+        page = matches[start:start + page_size]
+        response = {'kind': 'drive#fileList', 'incompleteSearch': False,
+                    'files': [self._project(item, _file_fields(fields)) for item in page]}
+        if start + page_size < len(matches):
+            response['nextPageToken'] = str(start + page_size)
+        return response
+
+    def _get_file(self, fileId: str, fields: str = None, **kwargs):
+        with self.lock:
+            return self._project(self._get(fileId), _file_fields(fields))
+
+    def _create(self, body: dict, fields: str = None, **kwargs):
+        with self.lock:
+            parents = body.get('parents') or []
+            for parent in parents:
+                self._get(parent)
+            file_id = self.add_file(body.get('name'), parents[0] if parents else None,
+                                    mime_type=body.get('mimeType', 'text/plain'))
+            return self._project(self.items[file_id], _file_fields(fields))
+
+    def _update(self, fileId: str, addParents: str = None, removeParents: str = None, body: dict = None,
+                fields: str = None, **kwargs):
+        with self.lock:
+            item = self._get(fileId)
+            if addParents:
+                destination = self._get(addParents)
+                drive_id = self.drive_of(destination.get('id'))
+                if drive_id and self.drive_of(fileId) != drive_id:
+                    if item.get('mimeType') == FOLDER_MIMETYPE:
+                        raise http_error(403, 'teamDrivesFolderMoveInNotSupported',
+                                         'Moving folders into shared drives is not supported.')
+                    if item.get('trashed'):
+                        raise http_error(403, 'cannotMoveTrashedItemIntoTeamDrive',
+                                         'Cannot move a trashed item into a shared drive.')
+                    owners = [owner.get('emailAddress') for owner in item.get('owners', [])]
+                    if owners and not any(self.is_member(drive_id, owner) for owner in owners):
+                        raise http_error(403, 'fileOwnerNotMemberOfTeamDrive',
+                                         'The file owner is not a member of the shared drive.')
+                    item.pop('owners', None)
+                for parent in (removeParents or '').split(','):
+                    if parent and parent in item['parents']:
+                        item['parents'].remove(parent)
+                        self.children.get(parent, {}).pop(fileId, None)
+                item['parents'].append(addParents)
+                self.children.setdefault(addParents, {})[fileId] = None
+            if body and body.get('name'):
+                item['name'] = body.get('name')
+            self.change_log.append(fileId)
+            return self._project(item, _file_fields(fields))
+
+    def _copy(self, fileId: str, body: dict = None, fields: str = None, **kwargs):
+        with self.lock:
+            item = self._get(fileId)
+            if item.get('mimeType') == FOLDER_MIMETYPE:
+                raise http_error(403, 'fileNotCopyable', 'Folders cannot be copied.')
+            parents = (body or {}).get('parents') or item.get('parents')
+            copy_id = self.add_file((body or {}).get('name', item.get('name')), parents[0] if parents else None,
+                                    mime_type=item.get('mimeType'), md5Checksum=item.get('md5Checksum'),
+                                    size=item.get('size'))
+            return self._project(self.items[copy_id], _file_fields(fields))
+
+    def _delete(self, fileId: str, **kwargs):
+        with self.lock:
+            item = self._get(fileId)
+            queue = [item.get('id')]
+            while queue:
+                file_id = queue.pop()
+                queue.extend(self.children.pop(file_id, {}))
+                removed = self.items.pop(file_id, None)
+                for parent in (removed or {}).get('parents', []):
+                    self.children.get(parent, {}).pop(file_id, None)
+                self.change_log.append(file_id)
+            return ''
+
+    def files(self):
+        return FakeResource(self, 'files', {'list': self._list, 'get': self._get_file, 'create': self._create,
+                                            'update': self._update, 'copy': self._copy, 'delete': self._delete})
+
+    # ---- permissions() -----------------------------------------------------------------------------------------
+
+    def _list_permissions(self, fileId: str, **kwargs):
+        with self.lock:
+            self._get(fileId)
+            drive_id = self.drive_of(fileId)
+            if drive_id:
+                permissions = [{'type': 'user', 'emailAddress': member, 'role': 'organizer'} if '@' in member
+                               else {'type': 'domain', 'domain': member, 'role': 'writer'}
+                               for member in sorted(self.drives[drive_id])]
+            else:
+                permissions = [{'type': 'user', 'emailAddress': owner.get('emailAddress'), 'role': 'owner'}
+                               for owner in self.items[fileId].get('owners', [])]
+            for i, permission in enumerate(permissions):
+                permission['id'] = f'p{i}'
+            return {'permissions': permissions}
+
+    def _update_permission(self, fileId: str, permissionId: str, transferOwnership: bool = False, **kwargs):
+        with self.lock:
+            item = self._get(fileId)
+            if transferOwnership:
+                item['owners'] = [{'emailAddress': self.user}]
+            return {'id': permissionId}
+
+    def permissions(self):
+        return FakeResource(self, 'permissions', {'list': self._list_permissions,
+                                                  'update': self._update_permission})
+
+    # ---- changes() ---------------------------------------------------------------------------------------------
+
+    def _get_start_page_token(self, **kwargs):
+        with self.lock:
+            return {'kind': 'drive#startPageToken', 'startPageToken': str(len(self.change_log))}
+
+    def _list_changes(self, pageToken: str, pageSize: int = 100, **kwargs):
+        """Every field of each changed file, whatever was asked for, plus driveId for files in a shared drive"""
+        with self.lock:
+            start = int(pageToken)
+            end = min(start + min(pageSize or 100, 1000), len(self.change_log))
+            changes = []
+            for file_id in self.change_log[start:end]:
+                change = {'kind': 'drive#change', 'changeType': 'file', 'fileId': file_id}
+                item = self.items.get(file_id)
+                if item is None:
+                    change['removed'] = True
+                else:
+                    file = dict(item, parents=list(item.get('parents', [])))
+                    if self.drive_of(file_id):
+                        file['driveId'] = self.drive_of(file_id)
+                    change.update(removed=False, file=file)
+                changes.append(change)
+            response = {'kind': 'drive#changeList', 'changes': changes}
+            if end < len(self.change_log):
+                response['nextPageToken'] = str(end)
+            else:
+                response['newStartPageToken'] = str(end)
+            return response
+
+    def changes(self):
+        return FakeResource(self, 'changes', {'getStartPageToken': self._get_start_page_token,
+                                              'list': self._list_changes})
+
+    def new_batch_http_request(self, callback=None):
+        return FakeBatch(self, callback)
@@ -0,0 +1,113 @@
+import json
+import random
+import re
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+'''
+A local HTTP server that answers the Zendesk endpoints zendesk_service uses, for benchmarking without a real
+Zendesk. Point a ZendeskClient at it with ZendeskClient(base_url=server.url).
+'''
+
+TICKET_FIELDS = [{'id': 360000001, 'title': 'Google Drive ID'}]
+
+
+class FakeZendesk:
+
+    def __init__(self, latency: float = 0.0, rate_limit_rate: float = 0.0, retry_after: int = 1, seed: int = 0):
+        """
+        :param latency: seconds every request takes
+        :param rate_limit_rate: chance that any request gets a 429 with a Retry-After header
+        :param retry_after: seconds to send in Retry-After
+        :param seed: seed for the 429 dice
+        """
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.tickets: dict[int, dict] = {}
+        self.calls = Counter()
+        self.server = None
+        self.thread = None
+
+    @property
+    def url(self):
+        return f'http://127.0.0.1:{self.server.server_port}/api/v2'
+
+    def start(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'  # keep-alive, like the real thing
+
+            def log_message(self, *args):
+                pass
+
+            def _send(self, status: int, body: dict, headers: dict = None):
+                data = json.dumps(body).encode('utf-8')
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(data)))
+                for key, value in (headers or {}).items():
+                    self.send_header(key, value)
+                self.end_headers()
+                self.wfile.write(data)
+
+            def _handle(self, method: str):
+                length = int(self.headers.get('Content-Length') or 0)
+                body = json.loads(self.rfile.read(length)) if length else {}
+                if fake.latency:
+                    time.sleep(fake.latency)
+                with fake.lock:
+                    fake.calls[method] += 1
+                    limited = fake.rate_limit_rate and fake.random.random() < fake.rate_limit_rate
+                if limited:
+                    self._send(429, {'error': 'APIRateLimitExceeded'}, {'Retry-After': str(fake.retry_after)})
+                    return
+                status, response = fake.route(method, self.path.split('?')[0], body)
+                self._send(status, response)
+
+            def do_GET(self):
+                self._handle('GET')
+
+            def do_PUT(self):
+                self._handle('PUT')
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        if self.server:
+            self.server.shutdown()
+            self.server.server_close()
+
+    def _apply(self, ticket_id: int, update: dict):
+        ticket = self.tickets.setdefault(ticket_id, {'id': ticket_id, 'custom_fields': {}, 'comments': []})
+        for field in update.get('custom_fields', []):
+            ticket['custom_fields'][field.get('id')] = field.get('value')
+        if update.get('comment'):
+            ticket['comments'].append(update.get('comment'))
+        return ticket
+
+    def route(self, method: str, path: str, body: dict):
+        with self.lock:
+            if method == 'GET' and path.endswith('/ticket_fields'):
+                return 200, {'ticket_fields': TICKET_FIELDS}
+            if method == 'GET' and path.endswith('/users/search'):
+                return 200, {'users': []}
+            if method == 'PUT' and path.endswith('/tickets/update_many.json'):
+                for update in body.get('tickets', []):
+                    self._apply(int(update.get('id')), update)
+                return 200, {'job_status': {'id': f'job{self.calls["PUT"]}', 'status': 'queued'}}
+            match = re.search(r'/tickets/(\d+)\.json$', path)
+            if match and method == 'GET':
+                ticket = self.tickets.get(int(match.group(1)))
+                return (200, {'ticket': ticket}) if ticket else (404, {'error': 'RecordNotFound'})
+            if match and method == 'PUT':
+                return 200, {'ticket': self._apply(int(match.group(1)), body.get('ticket', {}))}
+        return 404, {'error': 'InvalidEndpoint'}
@@ -0,0 +1,124 @@
+import collections
+import itertools
+import os
+import shutil
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.benchmark import (OLD_ROOT, DRIVE_ID, build_ticket_tree, build_destination, use_fakes,  # noqa: E402
+                             use_variables_template)
+from bench.fake_drive import FakeDrive, http_error, FOLDER_MIMETYPE  # noqa: E402
+from bench.fake_zendesk import FakeZendesk  # noqa: E402
+
+use_variables_template()
+import main  # noqa: E402
+from googleapiclient.errors import HttpError  # noqa: E402
+
+'''
+Kill a migration partway through, run it again, and check it ends up with the same shared drive as a migration that
+was never interrupted: no folder created twice, no file copied twice. The same goes for creates and copies that went
+through but whose response was lost.
+
+    python -m unittest bench.test_resume
+'''
+
+
+def build_tree():
+    drive = FakeDrive()
+    tickets = build_ticket_tree(drive, 500, 2, 2, 3, sorted(main.FOLDER_MAP), external_rate=0.1)
+    build_destination(drive, main.CONTAINER_ROOT, tickets)
+    return drive
+
+
+def shared_drive_paths(drive: FakeDrive, folders: bool):
+    """Counter of 'a/b/name' for the folders, or the files, in the shared drive, so two migrations can be compared"""
+    def path(item: dict):
+        names = []
+        while item and item.get('id') != DRIVE_ID:
+            names.append(item.get('name'))
+            item = drive.items.get((item.get('parents') or [None])[0])
+        return '/'.join(reversed(names))
+    return collections.Counter(path(item) for item in drive.items.values()
+                               if drive.drive_of(item.get('id')) == DRIVE_ID and item.get('id') != DRIVE_ID
+                               and (item.get('mimeType') == FOLDER_MIMETYPE) == folders)
+
+
+def left_behind(drive: FakeDrive):
+    return [item.get('name') for item in drive.items.values() if item.get('parents') == [OLD_ROOT]]
+
+
+class ResumeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.cwd = os.getcwd()
+        self.zendesk = FakeZendesk().start()
+        self.addCleanup(self.zendesk.stop)
+        self.addCleanup(os.chdir, self.cwd)
+        self.clean = build_tree()
+        self.migrate(self.clean)
+
+    def migrate(self, drive: FakeDrive):
+        self.addCleanup(shutil.rmtree, use_fakes(drive, self.zendesk), ignore_errors=True)
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+
+    def crash_after(self, drive: FakeDrive, method: str, calls: int):
+        """Kill the run right after the call-th call of files.<method> has gone through"""
+        real = getattr(drive, f'_{method}')
+        count = collections.Counter()
+
+        def crashing(**kwargs):
+            result = real(**kwargs)
+            count[method] += 1
+            if count[method] == calls:
+                raise http_error(400, 'badRequest', 'the migration was killed here')
+            return result
+        setattr(drive, f'_{method}', crashing)
+        return real
+
+    def assertResumed(self, drive: FakeDrive):
+        self.assertEqual(left_behind(drive), [])
+        self.assertEqual(shared_drive_paths(drive, folders=False), shared_drive_paths(self.clean, folders=False))
+        # structure folders FOLDER_MAP merges can hold same-named subfolders; a fresh run creates one of each, a
+        # resumed one may reuse the first, but it never creates one more than the uninterrupted run did
+        self.assertEqual(shared_drive_paths(drive, folders=True) - shared_drive_paths(self.clean, folders=True), {})
+        self.assertEqual(drive.calls['files.copy'], self.clean.calls['files.copy'])
+
+    def test_resume_after_folder_create(self):
+        drive = build_tree()
+        real = self.crash_after(drive, 'create', self.clean.calls['files.create'] // 2)
+        with self.assertRaises(HttpError):
+            self.migrate(drive)
+        drive._create = real
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+        self.assertResumed(drive)
+
+    def test_resume_after_move(self):
+        drive = build_tree()
+        real = self.crash_after(drive, 'update', self.clean.calls['files.update'] // 2)
+        with self.assertRaises(HttpError):
+            self.migrate(drive)
+        drive._update = real
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+        self.assertResumed(drive)
+
+    def test_lost_responses(self):
+        drive = build_tree()
+        for method in ('create', 'copy'):
+            real = getattr(drive, f'_{method}')
+
+            def lost(real=real, count=itertools.count(1), **kwargs):
+                """Every 5th call goes through, but its caller is told it failed"""
+                result = real(**kwargs)
+                if next(count) % 5 == 0:
+                    raise http_error(500, 'backendError', 'the response was lost')
+                return result
+            setattr(drive, f'_{method}', lost)
+        self.migrate(drive)
+        self.assertResumed(drive)
+
+
+if __name__ == '__main__':
+    unittest.main()
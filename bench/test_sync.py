@@ -0,0 +1,54 @@
+import os
+import shutil
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.benchmark import OLD_ROOT, DOMAIN, use_fakes  # noqa: E402
+from bench.fake_zendesk import FakeZendesk  # noqa: E402
+from bench.test_resume import build_tree  # noqa: E402
+import main  # noqa: E402
+
+'''
+Add things to a ticket after it was migrated and check sync_changes puts them where migrate_one would have.
+
+    python -m unittest bench.test_sync
+'''
+
+
+class SyncTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        self.zendesk = FakeZendesk().start()
+        self.addCleanup(self.zendesk.stop)
+        self.drive = build_tree()
+        self.addCleanup(shutil.rmtree, use_fakes(self.drive, self.zendesk), ignore_errors=True)
+        # keep the sources around, so there's somewhere to add things to
+        self.drive._delete = lambda fileId, **kwargs: ''
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+        self.ticket = next(row for row in main.state.tickets() if row.get('ticket_number') == '2')
+
+    def dest_path(self, file_id: str):
+        names = []
+        item = self.drive.items.get(file_id)
+        while item and item.get('id') != self.ticket.get('new_id'):
+            names.append(item.get('name'))
+            item = self.drive.items.get((item.get('parents') or [None])[0])
+        return '/'.join(reversed(names))
+
+    def test_new_folder_in_a_ticket_goes_into_its_structure_folder(self):
+        source_name, dest_name = next(iter(main.FOLDER_MAP.items()))
+        folder = self.drive.add_folder(source_name, self.ticket.get('old_id'))
+        new_file = self.drive.add_file('b.pdf', folder, owner=f'someone@{DOMAIN}')
+        nested = self.drive.add_file('c.pdf', self.drive.add_folder('inner', folder), owner=f'someone@{DOMAIN}')
+        main.sync_changes(OLD_ROOT)
+
+        self.assertEqual(self.dest_path(new_file), f'{dest_name}/b.pdf')
+        self.assertEqual(self.dest_path(nested), f'{dest_name}/inner/c.pdf')
+
+
+if __name__ == '__main__':
+    unittest.main()
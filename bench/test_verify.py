@@ -0,0 +1,108 @@
+import os
+import shutil
+import sys
+import unittest
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_ROOT)
+
+from bench.benchmark import OLD_ROOT, DOMAIN, use_fakes  # noqa: E402
+from bench.fake_drive import FakeDrive, FOLDER_MIMETYPE  # noqa: E402
+from bench.fake_zendesk import FakeZendesk  # noqa: E402
+from bench.test_resume import build_tree, left_behind  # noqa: E402
+import main  # noqa: E402
+from state_store import SOURCE_DELETED  # noqa: E402
+from tree_snapshot import TreeSnapshot  # noqa: E402
+
+'''
+Break a ticket's destination while it's migrated and check the source is kept and verify_all reports it.
+
+    python -m unittest bench.test_verify
+'''
+
+
+def ticket_of(drive: FakeDrive, file_id: str):
+    """Name of the ticket folder a source item is in"""
+    item = drive.items.get(file_id)
+    while item and item.get('parents') != [OLD_ROOT]:
+        item = drive.items.get((item.get('parents') or [None])[0])
+    return item.get('name') if item else None
+
+
+def first_file(drive: FakeDrive, ticket: int, external: bool):
+    """A file in 'Ticket #ticket' that will be copied (external) or moved into the shared drive"""
+    return next(file_id for file_id, item in drive.items.items()
+                if item.get('mimeType') != FOLDER_MIMETYPE and item.get('owners')
+                and (DOMAIN not in item['owners'][0].get('emailAddress')) == external
+                and (ticket_of(drive, file_id) or '').startswith(f'Ticket #{ticket} '))
+
+
+class VerifyTest(unittest.TestCase):
+
+    def setUp(self):
+        self.addCleanup(os.chdir, os.getcwd())
+        self.zendesk = FakeZendesk().start()
+        self.addCleanup(self.zendesk.stop)
+        self.drive = build_tree()
+        self.addCleanup(shutil.rmtree, use_fakes(self.drive, self.zendesk), ignore_errors=True)
+        self.elsewhere = self.drive.add_folder('somewhere outside the shared drive')
+
+    def lose_on_move(self, file_id: str):
+        """The file is moved into the shared drive, then taken out of it again"""
+        real = self.drive._update
+
+        def update(fileId: str, addParents: str = None, removeParents: str = None, **kwargs):
+            result = real(fileId=fileId, addParents=addParents, removeParents=removeParents, **kwargs)
+            if fileId == file_id and addParents and addParents != self.elsewhere:
+                real(fileId=fileId, addParents=self.elsewhere, removeParents=addParents)
+            return result
+        self.drive._update = update
+
+    def corrupt_on_copy(self, file_id: str):
+        """The file's copy arrives with different content"""
+        real = self.drive._copy
+
+        def copy(fileId: str, **kwargs):
+            result = real(fileId=fileId, **kwargs)
+            if fileId == file_id:
+                self.drive.items[result.get('id')]['md5Checksum'] = 'not what was copied'
+            return result
+        self.drive._copy = copy
+
+    def assertKept(self, ticket: int, problem: str):
+        ticket_name = next(name for name in left_behind(self.drive) if name.startswith(f'Ticket #{ticket} '))
+        row = next(row for row in main.state.tickets() if row.get('name') == ticket_name)
+        self.assertNotEqual(row.get('status'), SOURCE_DELETED)
+        queued = main.state.get_post_migration(row.get('old_id'))
+        self.assertIn('verification failed', queued.get('error'))
+        self.assertIn(problem, queued.get('error'))
+
+    def test_broken_destinations_keep_their_source(self):
+        self.lose_on_move(first_file(self.drive, 2, external=False))
+        self.corrupt_on_copy(first_file(self.drive, 3, external=True))
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+
+        self.assertEqual(sorted(name.split()[1] for name in left_behind(self.drive)), ['#2', '#3'])
+        self.assertKept(2, 'missing')
+        self.assertKept(3, 'mismatched')
+        problems = main.verify_all(path='verification.json')
+        self.assertEqual(sorted(report.get('ticket_number') for report in problems), ['2', '3'])
+        self.assertFalse(any(report.get('clean') for report in problems))
+
+    def test_empty_ticket_folder_is_deleted(self):
+        empty = self.drive.add_folder('Ticket #999 nothing in it', OLD_ROOT)
+        main.migrate_all(folder_id=OLD_ROOT, show_progress=False)
+
+        self.assertEqual(left_behind(self.drive), [])
+        self.assertEqual(main.state.get(empty).get('status'), SOURCE_DELETED)
+        self.assertIsNone(main.state.get_post_migration(empty))
+
+    def test_nothing_to_check_against_is_not_clean(self):
+        row = {'ticket_number': '1', 'old_id': 'gone', 'new_id': 'empty'}
+        report = main.diff_ticket(row, None, TreeSnapshot('empty'), folders={}, files={})
+        self.assertTrue(report.get('unverifiable'))
+        self.assertFalse(report.get('clean'))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -1,16 +1,37 @@
 import os
+import threading
 import traceback
+from concurrent.futures import ThreadPoolExecutor, wait
 
-from log import logger
+import httplib2
+import log
+from log import logger, locked_append
+from metrics import metrics
+from throttle import drive_throttle, copy_throttle, classify, is_ambiguous, reason_of
+from tree_snapshot import TreeSnapshot, FOLDER_MIMETYPE
 from google.oauth2.credentials import Credentials
 from googleapiclient.errors import HttpError
 from google_auth_oauthlib.flow import InstalledAppFlow
 from googleapiclient.discovery import build
 from google.auth.transport.requests import Request
+from google_auth_httplib2 import AuthorizedHttp
 
 CLIENT_SECRET_FILE = 'downloaded_credentials_file.json'
+TOKEN_FILE = 'token.json'
 SCOPES = ['https://www.googleapis.com/auth/drive']
-Q_FOLDERSONLY = "mimeType = 'application/vnd.google-apps.folder'"
+Q_FOLDERSONLY = f"mimeType = '{FOLDER_MIMETYPE}'"
+PAGE_SIZE = 1000  # the most files().list will return per page
+DEFAULT_FIELDS = 'id, name, mimeType'
+SNAPSHOT_FIELDS = 'id, name, mimeType, parents, md5Checksum, modifiedTime'
+SNAPSHOT_CHUNK_SIZE = 50  # folder ids per "in parents" query
+MAX_BATCH_SIZE = 100  # https://developers.google.com/drive/api/guides/performance#batch-requests
+CHANGE_FIELDS = 'fileId, removed, file(id, name, mimeType, parents, trashed, driveId)'
+COPY_WORKERS = 4  # copy fallbacks to run at once, see CopyPipeline
+COPIES_CSV = 'copies.csv'  # audit trail of copy fallbacks: old id, new id, old folder, new folder
+COPY_QUEUED = object()  # stands in for a file's new id while its copy is still queued
+_creds: ['SharedCredentials', None] = None  # see shared_creds
+_service = None  # see shared_service
+_shared_lock = threading.Lock()
 
 
 def authenticate():
@@ -24,77 +45,348 @@ def authenticate():
     return flow.run_local_server(port=8080)
 
 
+class SharedCredentials(Credentials):
+    """
+    OAuth credentials that every DriveClient and thread in a process can share. AuthorizedHttp refreshes them
+    whenever they've expired (or a call comes back 401), so a long run outlives its access token; here that refresh
+    happens once, under a lock, however many threads need it at the same time, and the new token is saved to
+    TOKEN_FILE.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._refresh_lock = threading.Lock()
+
+    def refresh(self, request):
+        token = self.token
+        with self._refresh_lock:
+            if self.token != token and self.valid:
+                return  # another thread refreshed them while we waited
+            logger.info('Refreshing Google credentials')
+            super().refresh(request)
+            save_creds(self)
+
+
 def get_creds_from_token_file():
-    with open('token.json', 'r', encoding='utf-8') as infile:
+    with open(TOKEN_FILE, 'r', encoding='utf-8') as infile:
         if 'refresh_token' not in infile.read():
             logger.warning("WARNING: No refresh token found in this file. You should remove your project's permissions"
                            "to your account and re-authenticate to create a token file which has one.")
-    return Credentials.from_authorized_user_file('token.json', SCOPES)
+    return SharedCredentials.from_authorized_user_file(TOKEN_FILE, SCOPES)
+
+
+def save_creds(creds):
+    """Write creds to TOKEN_FILE atomically, holding the file lock, since worker processes refresh on their own"""
+    tmp_path = f'{TOKEN_FILE}.{os.getpid()}.tmp'
+    with log.file_lock:
+        with open(tmp_path, 'w', encoding='utf-8') as token:
+            token.write(creds.to_json())
+        os.replace(tmp_path, TOKEN_FILE)
 
 
 def get_creds():
+    """
+    :return: credentials from TOKEN_FILE, refreshed if they've expired; if there's no token file yet, authenticate
+        in the browser and create one
+    """
     # https://developers.google.com/drive/api/v3/quickstart/python
     creds = None
-    if os.path.exists('token.json'):
+    if os.path.exists(TOKEN_FILE):
         creds = get_creds_from_token_file()
     if creds and creds.expired and creds.refresh_token:
         logger.debug('refreshing your token!')
         creds.refresh(Request())
     if not creds:
-        creds = authenticate()
-    with open('token.json', 'w', encoding='utf-8') as token:
-        token.write(creds.to_json())
+        flow_creds = authenticate()
+        save_creds(flow_creds)
+        creds = get_creds_from_token_file()
+    return creds
+
+
+def shared_creds():
+    """One SharedCredentials per process, loaded the first time they're needed. Forked workers keep the parent's."""
+    global _creds
+    with _shared_lock:
+        if _creds is None:
+            _creds = get_creds()
+        return _creds
+
+
+def shared_service(credentials):
+    """
+    The Drive v3 service, built once per process from the discovery document that ships with googleapiclient
+    (static_discovery), so creating a DriveClient never fetches or parses it again. DriveClient passes its own http
+    with every request, so the one service is safe to share between threads.
+    """
+    global _service
+    with _shared_lock:
+        if _service is None:
+            _service = build('drive', 'v3', credentials=credentials, static_discovery=True, cache_discovery=False)
+        return _service
+
+
+class CountingHttp(httplib2.Http):
+    """httplib2.Http that adds the size of every request and response body to the drive bytes metrics"""
+
+    def request(self, uri, method='GET', body=None, headers=None, *args, **kwargs):
+        response, content = super().request(uri, method, body, headers, *args, **kwargs)
+        metrics.add_bytes('drive', sent=len(body or b''), received=len(content or b''))
+        return response, content
 
 
 class DriveClient:
     service = None
+    credentials = None
 
-    def __init__(self):
+    def __init__(self, service=None):
+        """:param service: an already-built Drive v3 service (or a stand-in, like bench.fake_drive) to use as-is"""
+        self._local = threading.local()
+        self.copy_pipeline: [CopyPipeline, None] = None
+        if service is not None:
+            self.service = service
+            return
         try:
-            self.service = build('drive', 'v3', credentials=get_creds_from_token_file())
+            self.credentials = shared_creds()
+            self.service = shared_service(self.credentials)
         except Exception as e:
             logger.error(f"The Google Drive API couldn't authenticate you. Here's the error it returned: \n{e}")
             exit(1)
 
+    def _http(self):
+        """
+        httplib2 isn't thread-safe, so every thread gets its own authorized connection.
+        See https://googleapis.github.io/google-api-python-client/docs/thread_safety.html
+        """
+        if self.credentials is None:
+            return None
+        http = getattr(self._local, 'http', None)
+        if http is None:
+            http = AuthorizedHttp(self.credentials, http=CountingHttp())
+            self._local.http = http
+        return http
+
+    def _execute(self, request, cost: int = 1, throttle=drive_throttle, idempotent: bool = True):
+        """Run a request (or batch of `cost` requests) through the shared rate limiter and retry policy"""
+        label = getattr(request, 'methodId', None) or 'drive.batch'  # e.g. drive.files.list
+        return throttle.call(request.execute, http=self._http(), cost=cost, label=label.split('.', 1)[-1],
+                             idempotent=idempotent)
+
+    def set_copy_pipeline(self, pipeline: 'CopyPipeline'):
+        """Hand copy fallbacks to pipeline instead of copying inline; None goes back to copying inline"""
+        self.copy_pipeline = pipeline
+
     def delete_folder(self, folder_id: str):
-        self.service.files().delete(fileId=folder_id, supportsAllDrives=True).execute()
+        self._execute(self.service.files().delete(fileId=folder_id, supportsAllDrives=True))
 
-    def create_folder(self, name: str, parent: str):
+    def _create_folder_request(self, name: str, parent: str):
         file_md = {
             'name': name,
-            'mimeType': 'application/vnd.google-apps.folder',
+            'mimeType': FOLDER_MIMETYPE,
             'parents': [parent]
         }
-        file = self.service.files().create(body=file_md,
+        return self.service.files().create(body=file_md,
                                            fields='id',
-                                           supportsAllDrives=True).execute()
+                                           supportsAllDrives=True)
+
+    def _create_folder(self, name: str, parent: str):
+        file = self._execute(self._create_folder_request(name, parent), idempotent=False)
+        metrics.count('folders_created')
         return file.get('id')
 
-    def get_file(self, file_id: str):
-        return self.service.files().get(fileId=file_id,
-                                        supportsAllDrives=True).execute()
+    def create_folder(self, name: str, parent: str):
+        try:
+            return self._create_folder(name, parent)
+        except Exception as e:
+            if not is_ambiguous(e):
+                raise
+            return self._find_or_create_folders([name], parent)[name]
+
+    def _find_or_create_folders(self, names: list, parent: str):
+        """For creates that failed with a 5xx or a timeout, which may have gone through anyway: look, then create"""
+        existing = self.get_structure(parent)
+        return {name: existing.get(name) or self._create_folder(name, parent) for name in names}
+
+    def create_folders(self, names: list, parent: str):
+        """
+        Create several folders under one parent with a batch request per MAX_BATCH_SIZE of them. Folders that fail
+        inside a batch with a retryable error are created again on their own, unless they turn out to exist already.
+
+        :return: {name: id}
+        """
+        if len(names) == 1:
+            return {names[0]: self.create_folder(names[0], parent)}
+        created = {}
+        for i in range(0, len(names), MAX_BATCH_SIZE):
+            chunk = names[i:i + MAX_BATCH_SIZE]
+            failed = []
+
+            def callback(request_id, response, exception):
+                if exception is not None:
+                    metrics.error('drive', 'files.create', reason_of(exception))
+                    failed.append((chunk[int(request_id)], exception))
+                else:
+                    created[chunk[int(request_id)]] = response.get('id')
+
+            batch = self.service.new_batch_http_request(callback=callback)
+            for j, name in enumerate(chunk):
+                batch.add(self._create_folder_request(name, parent), request_id=str(j))
+            try:
+                self._execute(batch, cost=len(chunk), idempotent=False)
+            except Exception as e:
+                if not is_ambiguous(e):
+                    raise
+                failed = [(name, e) for name in chunk if name not in created]
+            metrics.count('folders_created', len(chunk) - len(failed))
+            if any(classify(exception)[2] for _, exception in failed):
+                drive_throttle.backed_off()  # once for the whole batch, it was one request
+            for name, exception in failed:
+                if not classify(exception)[0]:
+                    raise exception
+            unsure = [name for name, exception in failed if is_ambiguous(exception)]
+            if unsure:
+                created.update(self._find_or_create_folders(unsure, parent))
+            for name, exception in failed:
+                if name not in created:  # rate limited, so it wasn't created
+                    created[name] = self._create_folder(name, parent)
+        return created
+
+    def get_file(self, file_id: str, fields: str = None):
+        return self._execute(self.service.files().get(fileId=file_id,
+                                                      fields=fields,
+                                                      supportsAllDrives=True))
+
+    def get_start_page_token(self):
+        """Token for the changes feed as of now, see iter_change_pages"""
+        return self._execute(self.service.changes().getStartPageToken(supportsAllDrives=True)).get('startPageToken')
+
+    def iter_change_pages(self, page_token: str, fields: str = CHANGE_FIELDS):
+        """
+        Yield every page of changes since page_token, across My Drive and every shared drive we're in
+        See https://developers.google.com/drive/api/guides/manage-changes
+
+        :param fields: which fields to get for each change
+        :return: yields (changes, new_start_page_token), where the token is only set on the last page. Save it to pick
+            up from there next time.
+        """
+        while page_token:
+            response = self._execute(self.service.changes().list(pageToken=page_token,
+                                                                 fields=f'nextPageToken, newStartPageToken, '
+                                                                        f'changes({fields})',
+                                                                 spaces='drive',
+                                                                 supportsAllDrives=True,
+                                                                 includeItemsFromAllDrives=True,
+                                                                 pageSize=PAGE_SIZE))
+            page_token = response.get('nextPageToken')
+            yield response.get('changes', []), response.get('newStartPageToken')
+
+    def query(self, q: str, next_page_token: str = None, fields: str = DEFAULT_FIELDS, page_size: int = PAGE_SIZE):
+        """run one page of a files().list query, e.g. q="parents = 'abc' and trashed = false" """
+        return self._execute(self.service.files().list(q=q,
+                                                       fields=f'nextPageToken, files({fields})',
+                                                       corpora='allDrives',  # https://stackoverflow.com/a/66357508
+                                                       supportsAllDrives=True,
+                                                       includeItemsFromAllDrives=True,
+                                                       pageSize=page_size,
+                                                       pageToken=next_page_token))
 
-    def list_files(self, folder_id: str, folders_only: bool = False, next_page_token: str = None):
-        """list all items within a folder"""
+    def list_files(self, folder_id: str, folders_only: bool = False, next_page_token: str = None,
+                   fields: str = DEFAULT_FIELDS, page_size: int = PAGE_SIZE):
+        """list one page of the items within a folder. Use iter_files to get all of them"""
+        return self.query(q=self._folder_query(folder_id, folders_only), next_page_token=next_page_token,
+                          fields=fields, page_size=page_size)
+
+    @staticmethod
+    def _folder_query(folder_id: str, folders_only: bool = False):
         q = f"parents = '{folder_id}'"
         if folders_only:
-            q += " and mimeType = 'application/vnd.google-apps.folder'"
+            q += f' and {Q_FOLDERSONLY}'
+        return q
+
+    def iter_query_pages(self, q: str, fields: str = DEFAULT_FIELDS, prefetch: bool = False):
+        """
+        Yield every page of a files().list query, as lists of file dicts
+
+        :param q: query string
+        :param fields: which fields to get for each file, e.g. 'id, name, mimeType, parents'
+        :param prefetch: fetch the next page in the background while the caller works on the current one
+        """
+        def fetch(page_token):
+            return self.query(q=q, next_page_token=page_token, fields=fields)
+
+        if not prefetch:
+            response = fetch(None)
+            while response:
+                next_page_token = response.get('nextPageToken', None)
+                yield response.get('files', [])
+                response = fetch(next_page_token) if next_page_token else None
+            return
+
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            future = executor.submit(fetch, None)
+            while future:
+                response = future.result()
+                next_page_token = response.get('nextPageToken', None)
+                future = executor.submit(fetch, next_page_token) if next_page_token else None
+                yield response.get('files', [])
+
+    def iter_pages(self, folder_id: str, folders_only: bool = False, fields: str = DEFAULT_FIELDS,
+                   prefetch: bool = False):
+        """Yield every page of the items within a folder. See iter_query_pages for the parameters"""
+        return self.iter_query_pages(self._folder_query(folder_id, folders_only), fields=fields, prefetch=prefetch)
 
-        return self.service.files().list(q=q,
-                                         fields='nextPageToken, files(id, name, mimeType)',
-                                         corpora='allDrives',  # https://stackoverflow.com/a/66357508
-                                         supportsAllDrives=True,
-                                         includeItemsFromAllDrives=True,
-                                         pageToken=next_page_token).execute()
+    def iter_files(self, folder_id: str, folders_only: bool = False, fields: str = DEFAULT_FIELDS,
+                   prefetch: bool = False):
+        """Yield every item within a folder, fetching pages lazily. See iter_query_pages for the parameters"""
+        for page in self.iter_pages(folder_id=folder_id, folders_only=folders_only, fields=fields, prefetch=prefetch):
+            yield from page
+
+    def snapshot_tree(self, root_id: str, fields: str = SNAPSHOT_FIELDS, chunk_size: int = SNAPSHOT_CHUNK_SIZE,
+                      max_workers: int = 4):
+        """
+        Fetch everything under a folder into a TreeSnapshot. Rather than one listing per folder, each level of the
+        tree is fetched with "'a' in parents or 'b' in parents or ..." queries covering chunk_size folders each.
+
+        :param root_id: folder to snapshot
+        :param fields: which fields to get for each file; must include id, mimeType and parents
+        :param chunk_size: folders per query. Bigger means fewer calls, but the query string has to fit in a URL
+        :param max_workers: number of queries to run at once
+        """
+        snapshot = TreeSnapshot(root_id)
+        frontier = [root_id]
+
+        def fetch(chunk):
+            q = '(' + ' or '.join(f"'{folder_id}' in parents" for folder_id in chunk) + ')'
+            return [item for page in self.iter_query_pages(q, fields=fields) for item in page]
+
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while frontier:
+                chunks = [frontier[i:i + chunk_size] for i in range(0, len(frontier), chunk_size)]
+                frontier = []
+                for items in executor.map(fetch, chunks):
+                    for item in items:
+                        if snapshot.add(item) and item.get('mimeType') == FOLDER_MIMETYPE:
+                            frontier.append(item.get('id'))
+                logger.debug(f'Snapshot of {root_id}: {len(snapshot)} items so far')
+        return snapshot
+
+    def list_permissions(self, file_id: str, fields: str = 'id, type, emailAddress, domain, role'):
+        """every permission on a file (for a shared drive or an item in one, that includes the drive's members)"""
+        permissions = []
+        next_page_token = None
+        while True:
+            response = self._execute(self.service.permissions().list(fileId=file_id,
+                                                                     fields=f'nextPageToken, permissions({fields})',
+                                                                     supportsAllDrives=True,
+                                                                     pageToken=next_page_token))
+            permissions.extend(response.get('permissions', []))
+            next_page_token = response.get('nextPageToken', None)
+            if not next_page_token:
+                return permissions
 
     def get_structure(self, folder_id: str):
         """If this is an already-recreated folder structure, get its folder map"""
-        q = f"parents = '{folder_id}' and mimeType = 'application/vnd.google-apps.folder'"
-        folders_list = self.service.files().list(q=q,
-                                                 fields='files(id, name)',
-                                                 supportsAllDrives=True,
-                                                 includeItemsFromAllDrives=True).execute()
-        return {folder.get('name'): folder.get('id') for folder in folders_list.get('files')}
+        return {folder.get('name'): folder.get('id')
+                for folder in self.iter_files(folder_id, folders_only=True, fields='id, name')}
 
     def move_all_content_location(self, old_folder: str, new_folder: str, folders_only=False):
         """
@@ -104,62 +396,244 @@ class DriveClient:
         :param new_folder: folder to move to
         :param folders_only: only move folders (i.e. folder-type files)
         """
+        # list everything before moving anything, since paging through a folder while emptying it skips items
+        file_list = [listing.get('id') for listing in self.iter_files(old_folder, folders_only=folders_only,
+                                                                      fields='id')]
+        self.move_files_location(old_folder=old_folder, new_folder=new_folder, file_list=file_list)
 
-        q = f"parents = '{old_folder}'"
-        if folders_only:
-            q += f' and {Q_FOLDERSONLY}'
-        response = self.list_files(folder_id=old_folder, folders_only=folders_only)
-        while response:
-            file_list = [listing.get('id') for listing in response.get('files')]
-            next_page_token = response.get('nextPageToken', None)
-            self.move_files_location(old_folder=old_folder, new_folder=new_folder, file_list=file_list)
-            if next_page_token:
-                response = self.list_files(folder_id=old_folder, next_page_token=next_page_token)
-            else:
-                response = None
-
-    def copy_file(self, file_id: str):
-        r = self.service.files().copy(fileId=file_id, fields='id', supportsAllDrives=True).execute()
+    def copy_file(self, file_id: str, parent: str = None, throttle=drive_throttle):
+        """:param parent: folder to create the copy in, instead of next to the original"""
+        body = {'parents': [parent]} if parent else {}
+        try:
+            r = self._execute(self.service.files().copy(fileId=file_id, body=body, fields='id',
+                                                        supportsAllDrives=True), throttle=throttle, idempotent=False)
+        except Exception as e:
+            if not parent or not is_ambiguous(e):
+                raise
+            # the copy may have been made anyway, so look for it before making another
+            existing = self.find_copy(file_id, parent)
+            if existing:
+                return existing
+            r = self._execute(self.service.files().copy(fileId=file_id, body=body, fields='id',
+                                                        supportsAllDrives=True), throttle=throttle, idempotent=False)
         return r.get('id')
 
+    def find_copy(self, file_id: str, folder_id: str):
+        """:return: id of a file in folder_id with the same name and content as file_id, or None"""
+        original = self.get_file(file_id, fields='name, md5Checksum')
+        for item in self.iter_files(folder_id, fields='id, name, md5Checksum'):
+            if item.get('name') == original.get('name') and item.get('md5Checksum') == original.get('md5Checksum'):
+                return item.get('id')
+        return None
+
+    def _move_request(self, old_folder: str, new_folder: str, file_id: str):
+        return self.service.files().update(supportsAllDrives=True, fileId=file_id, addParents=new_folder,
+                                           removeParents=old_folder, fields='id, parents')
+
+    def _handle_move_error(self, old_folder: str, new_folder: str, file_id: str, httpe: HttpError):
+        """
+        Deal with an HttpError raised by moving a single file, whether it was sent on its own or in a batch
+
+        :return: id of the copy that was made instead, None if the file was left where it is, or COPY_QUEUED if it was
+            handed to the copy pipeline
+        """
+        err_reason = httpe.error_details[0].get('reason')
+        if err_reason == 'cannotMoveTrashedItemIntoTeamDrive':
+            metrics.count('trashed_left_behind')
+            return None
+        elif err_reason in ['fileOwnerNotMemberOfTeamDrive', 'fileOwnerNotMemberOfWriterDomain']:
+            # when moving files to a shared drive, if original file owner isn't a member of it
+            if self.copy_pipeline is not None:
+                self.copy_pipeline.submit(file_id, old_folder, new_folder)
+                return COPY_QUEUED
+            copy_id = self.copy_file(file_id, parent=new_folder)
+            metrics.count('copy_fallbacks')
+            logger.info(f'Owner of {file_id} is not a member of the destination drive; '
+                        f'copied it to {new_folder} instead')
+            return copy_id
+        else:
+            logger.critical(f'ERROR {httpe.status_code} while processing {old_folder}/{file_id} with reason '
+                            f'{httpe.reason}. Details: {httpe.error_details}')
+            raise httpe
+
     def _move_file_location(self, old_folder: str, new_folder: str, file_id: str):
+        """:return: id the file ended up as in new_folder (see _handle_move_error)"""
         try:
-            self.service.files().update(supportsAllDrives=True, fileId=file_id, addParents=new_folder,
-                                        removeParents=old_folder, fields='id, parents'
-                                        ).execute()
-        # should probably also catch these read timeouts somehow, though I'm not sure what to do about it. wait 1000?
+            self._execute(self._move_request(old_folder, new_folder, file_id))
+            return file_id
+        # rate limit errors, 5xx's and read timeouts were already retried by drive_throttle by the time we get here
         except HttpError as httpe:
-            err_reason = httpe.error_details[0].get('reason')
-            if err_reason == 'cannotMoveTrashedItemIntoTeamDrive':
-                pass
-            elif err_reason in ['fileOwnerNotMemberOfTeamDrive', 'fileOwnerNotMemberOfWriterDomain']:
-                # when moving files to a shared drive, if original file owner isn't a member of it
-                copy_id = self.copy_file(file_id)
-                self._move_file_location(old_folder, new_folder, copy_id)
-                logger.info(f'Owner of {file_id} is not a member of the destination drive; '
-                            f'moved a copy to {new_folder} instead')
-            else:
-                logger.critical(f'ERROR {httpe.status_code} while processing {old_folder}/{file_id} with reason '
-                                f'{httpe.reason}. Details: {httpe.error_details}')
-                raise httpe
+            return self._handle_move_error(old_folder, new_folder, file_id, httpe)
         except Exception as e:
-            with open('err.txt', 'a') as errfile:
+            with locked_append('err.txt') as errfile:
                 errfile.write(f'Error while processing {old_folder}/{file_id}: {str(e)}!\n')
                 traceback.print_exc(file=errfile)
             raise e
 
-    def move_files_location(self, old_folder: str, new_folder: str, file_list: list):
+    def _move_files_batch(self, old_folder: str, new_folder: str, file_list: list):
+        """
+        Move up to MAX_BATCH_SIZE files with a single HTTP batch request. Items that fail inside the batch get the
+        same error handling as _move_file_location, once the whole batch has come back.
+
+        :return: {file id: id it ended up as}, see _move_file_location
+        """
+        failed = []
+
+        def callback(request_id, response, exception):
+            if exception is not None:
+                metrics.error('drive', 'files.update', reason_of(exception))
+                failed.append((file_list[int(request_id)], exception))
+
+        batch = self.service.new_batch_http_request(callback=callback)
+        for i, file_id in enumerate(file_list):
+            batch.add(self._move_request(old_folder, new_folder, file_id), request_id=str(i))
+        try:
+            self._execute(batch, cost=len(file_list))
+        except Exception as e:
+            with locked_append('err.txt') as errfile:
+                errfile.write(f'Error while processing batch of {len(file_list)} files in {old_folder}: {str(e)}!\n')
+                traceback.print_exc(file=errfile)
+            raise e
+
+        moved = {file_id: file_id for file_id in file_list}
+        if any(classify(exception)[2] for _, exception in failed):
+            drive_throttle.backed_off()  # once for the whole batch, it was one request
+        for file_id, exception in failed:
+            if classify(exception)[0]:
+                # throttled or failed on Google's end: retry it on its own, with backoff
+                moved[file_id] = self._move_file_location(old_folder=old_folder, new_folder=new_folder,
+                                                          file_id=file_id)
+            elif isinstance(exception, HttpError):
+                moved[file_id] = self._handle_move_error(old_folder, new_folder, file_id, exception)
+            else:
+                raise exception
+        return moved
+
+    def move_files_location(self, old_folder: str, new_folder: str, file_list: list, batched: bool = True):
         """
         Move specific list of files to a different folder
 
         :param old_folder: folder to move from. Yes, Google needs this. Google calls "removeParents" with it.
         :param new_folder: folder to move to
         :param file_list: list of files to move
-        :return:
+        :param batched: send the moves in batches of MAX_BATCH_SIZE instead of one request per file
+        :return: {file id: id it ended up as in new_folder}. That's the file's own id, unless its owner isn't a member
+            of the destination drive and a copy was made instead, or None for a trashed file that stayed behind. Files
+            handed to the copy pipeline are left out; it reports them itself once they're copied.
+        """
+        moved = {}
+        if not batched:
+            for file_id in file_list:
+                moved[file_id] = self._move_file_location(old_folder=old_folder, new_folder=new_folder,
+                                                          file_id=file_id)
+                metrics.count('files_moved')
+            return {file_id: new_id for file_id, new_id in moved.items() if new_id is not COPY_QUEUED}
+        for i in range(0, len(file_list), MAX_BATCH_SIZE):
+            chunk = file_list[i:i + MAX_BATCH_SIZE]
+            if len(chunk) == 1:
+                moved[chunk[0]] = self._move_file_location(old_folder=old_folder, new_folder=new_folder,
+                                                           file_id=chunk[0])
+            else:
+                moved.update(self._move_files_batch(old_folder=old_folder, new_folder=new_folder, file_list=chunk))
+            metrics.count('files_moved', len(chunk))
+        return {file_id: new_id for file_id, new_id in moved.items() if new_id is not COPY_QUEUED}
+
+    def change_owner(self, file_id: str, permission_id: str, throttle=drive_throttle):
+        """Make whoever has permission_id on a file its owner. Only the current owner can do this."""
+        return self._execute(self.service.permissions().update(supportsAllDrives=True, fileId=file_id,
+                                                               permissionId=permission_id, body={'role': 'owner'},
+                                                               transferOwnership=True),
+                             throttle=throttle)
+
+
+class CopyPipeline:
+
+    def __init__(self, client: DriveClient, max_workers: int = COPY_WORKERS, on_copied=None,
+                 owner_permission_id: str = None, audit_path: str = COPIES_CSV):
         """
-        for file_id in file_list:
-            self._move_file_location(old_folder=old_folder, new_folder=new_folder, file_id=file_id)
+        Runs copy fallbacks (files whose owner isn't a member of the destination drive, so they can't be moved) on
+        their own threads and their own rate budget, copy_throttle, so the moves that queue them never wait on them.
+        Copies are made straight into the destination folder, so there's no second update to move them.
+
+        :param client: DriveClient to copy with
+        :param max_workers: copies to run at once
+        :param on_copied: called with (source folder id, file id, id it ended up as) once a file is dealt with
+        :param owner_permission_id: if given, first try making this permission (a member of the destination drive)
+            the file's owner with change_owner and moving the original. Files that can't be transferred get copied.
+        :param audit_path: every old id -> new id is appended to this CSV
+        """
+        self.client = client
+        self.executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix='copy')
+        self.on_copied = on_copied
+        self.owner_permission_id = owner_permission_id
+        self.audit_path = audit_path
+        self.lock = threading.Lock()
+        self.pending = set()
+
+    def submit(self, file_id: str, old_folder: str, new_folder: str):
+        future = self.executor.submit(self._copy, file_id, old_folder, new_folder)
+        with self.lock:
+            self.pending.add(future)
+        return future
+
+    def _transfer(self, file_id: str, old_folder: str, new_folder: str):
+        """:return: whether ownership of the file could be transferred and the original moved"""
+        try:
+            self.client.change_owner(file_id, self.owner_permission_id, throttle=copy_throttle)
+            self.client._execute(self.client._move_request(old_folder, new_folder, file_id), throttle=copy_throttle)
+            return True
+        except HttpError as httpe:
+            logger.info(f'Could not transfer ownership of {file_id} ({reason_of(httpe)}), copying it instead')
+            return False
+
+    def _copy(self, file_id: str, old_folder: str, new_folder: str):
+        if self.owner_permission_id and self._transfer(file_id, old_folder, new_folder):
+            new_id = file_id
+            metrics.count('ownership_transfers')
+        else:
+            new_id = self.client.copy_file(file_id, parent=new_folder, throttle=copy_throttle)
+            metrics.count('copy_fallbacks')
+            logger.info(f'Owner of {file_id} is not a member of the destination drive; '
+                        f'copied it to {new_folder} as {new_id} instead')
+        with locked_append(self.audit_path) as audit:
+            audit.write(f'{file_id},{new_id},{old_folder},{new_folder}\n')
+        if self.on_copied:
+            self.on_copied(old_folder, file_id, new_id)
+        return new_id
+
+    def wait(self):
+        """Block until every queued copy is done, then raise the first error any of them hit"""
+        error = None
+        while True:
+            with self.lock:
+                pending, self.pending = self.pending, set()
+            if not pending:
+                break
+            wait(pending)
+            for future in pending:
+                if error is None and future.exception() is not None:
+                    error = future.exception()
+        if error is not None:
+            raise error
+
+    def close(self):
+        try:
+            self.wait()
+        finally:
+            self.executor.shutdown()
+
+
+class LazyDriveClient:
+    """Stands in for a DriveClient that only gets built (and authenticates) the first time it's used"""
+
+    def __init__(self, factory=DriveClient):
+        self._factory = factory
+        self._client = None
+        self._lock = threading.Lock()
 
-    def change_owner(self, file_id: str, permission_id: str):
-        self.service.permissions().update(supportsAllDrive=True, fileId=file_id, permissionId=permission_id,
-                                          transferOwnership=True, )
+    def __getattr__(self, name):
+        if self._client is None:
+            with self._lock:
+                if self._client is None:
+                    self._client = self._factory()
+        return getattr(self._client, name)
@@ -1,6 +1,25 @@
 import logging
+import threading
+from contextlib import contextmanager
 
 log_level = 'INFO'
 logging.basicConfig(filename='out.log', style='{', format='{asctime}s {levelname}:{name}: {message}')
 logger = logging.getLogger("main")
 logger.setLevel(log_level)
+
+# guards appends to the shared bookkeeping files (ids.csv, done, err.txt). Worker processes swap this for a
+# multiprocessing.Lock shared with the parent, see set_file_lock
+file_lock = threading.Lock()
+
+
+def set_file_lock(lock):
+    global file_lock
+    file_lock = lock
+
+
+@contextmanager
+def locked_append(path: str):
+    """Open a file for appending while holding file_lock, so writes from several workers don't interleave"""
+    with file_lock:
+        with open(path, 'a', encoding='utf-8') as outfile:
+            yield outfile
@@ -1,102 +1,296 @@
+import bisect
+import functools
+import glob
+import math
+import multiprocessing
+import multiprocessing.pool
+import multiprocessing.util
+import sys
+import threading
+import time
 import traceback
-from log import logger
-from drive_service import DriveClient
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+import log
+from log import logger, locked_append
+from drive_service import DriveClient, LazyDriveClient, CopyPipeline, DEFAULT_FIELDS, MAX_BATCH_SIZE, PAGE_SIZE
 import json
 import os
 import variables as vvars
 import zendesk_service as zd
+import throttle
+from metrics import metrics, merge, read_snapshots
+from state_store import StateStore, FILES_MOVED, ZENDESK_UPDATED, SOURCE_DELETED, FOLDER_DONE
+from tree_snapshot import TreeSnapshot, FOLDER_MIMETYPE
 from googleapiclient.errors import HttpError
 
 '''
 This file contains all custom logic for migrating all folders and files from shared folder to Shared Drive.
 '''
 
-dc = DriveClient()
-IDCSV = 'ids.csv'
+dc = LazyDriveClient()  # so importing this module doesn't need credentials
+IDCSV = 'ids.csv'  # legacy bookkeeping, imported into the state store on startup
+STATE_DB = 'migration.db'
+state = StateStore(STATE_DB)
+snapshot: [TreeSnapshot, None] = None  # pre-fetched source tree, see load_snapshot
+copies: [CopyPipeline, None] = None  # runs copy fallbacks in the background, see start_copy_pipeline
+post_migration: ['PostMigrationStage', None] = None  # Zendesk updates and source deletion, see start_post_migration
 OLDCASE = vvars.F_Redacted
 NEWCASE = vvars.F_TEAM_DRIVE_Redacted
 STRUCTURE = ['redacted list of desired subfolder structure for new shared drive folders']
 ZD_MOVED_COMMENT = 'During a Google Drive migration to the shared drive, some files were moved...'
 FOLDER_MAP = {'redacted old folder': 'redacted new folder', 'redacted1': 'redacted2', 'redacted2': 'redacted2'}
+MIGRATION_WORKERS = 8  # concurrent Drive calls per subfolder tree; keep this under Drive's per-user quota
+DONE_CHUNK_SIZE = 1000  # finished folders to mark done at a time while walking a big tree
+CONTAINER_ROOT = 'redacted'  # holds the numbered container folders new ticket folders go into
+FOLDER_CACHE = 'folder_cache.json'
+PLAN_FIELDS = 'id, name, mimeType, trashed, owners(emailAddress)'
+DEFAULT_CALL_LATENCY = 0.3  # seconds per Drive call, when a plan didn't get to measure any
+OWNER_PERMISSION_ID = None  # a destination drive member's permission id, to try ownership transfers before copying
+SYNC_TOKEN = 'changes_start_page_token'  # state store setting sync_changes picks up the changes feed from
+METRICS_DIR = 'metrics'  # metrics.json, plus one snapshot per worker process
+METRICS_INTERVAL = 10  # seconds between metrics snapshots and progress lines
+POST_WORKERS = 4  # concurrent Drive calls in the post-migration stage
+POST_LINGER = 30  # seconds a ticket waits for a full Zendesk batch before a smaller one goes out
+POST_POLL_INTERVAL = 1  # seconds between looks at the post-migration queue when it has nothing to do
+POST_LEASE = 600  # seconds a claimed ticket is left alone by other processes working the queue
+POST_RETRY_BASE = 30  # seconds before the first retry of a failed post-migration step, doubling from there
+POST_RETRY_MAX = 1800
+POST_DRAIN_TIMEOUT = 300  # seconds to keep sending queued updates for once the migration itself is done
+VERIFY_BEFORE_DELETE = True  # only delete a ticket's source folder once verify_ticket finds nothing missing
+VERIFY_FIELDS = 'id, name, mimeType, parents, size, md5Checksum, trashed'
+VERIFY_WORKERS = 16  # tickets verified at once by verify_all
+
+
+def list_container_folders(container_id: str):
+    return {item.get('name'): item.get('id') for item in dc.iter_files(container_id, fields='id, name')}
 
 
 def cache_container_folders():
-    if os.stat('folder_cache.json').st_size > 2:
+    if os.path.exists(FOLDER_CACHE) and os.stat(FOLDER_CACHE).st_size > 2:
         return
-    ticket_l0 = 'redacted'
-    tickets_l1 = dc.list_files(ticket_l0).get('files')  # 2000-level containers
-    cache = {}
-    for item in tickets_l1:
-        n, i = item.get('name'), item.get('id')
-        cache[n] = {'id': i, 'folders': {}}
-        tmp_tickets_l2 = dc.list_files(i).get('files')
-        cache[n]['folders'] = {item_l2.get('name'): item_l2.get('id') for item_l2 in tmp_tickets_l2}
-    with open('folder_cache.json', 'w', encoding='utf-8') as outfile:
+    tickets_l1 = list_container_folders(CONTAINER_ROOT)  # 2000-level containers
+    cache = {n: {'id': i, 'folders': list_container_folders(i)} for n, i in tickets_l1.items()}
+    with open(FOLDER_CACHE, 'w', encoding='utf-8') as outfile:
         json.dump(obj=cache, fp=outfile)
 
 
+def parse_range(range_str: str):
+    """'1-50' -> (1, 50)"""
+    start, end = range_str.split('-')
+    return int(start), int(end)
+
+
+class ContainerIndex:
+    """
+    Every 2nd-level container folder as a (start, end) ticket range, sorted by start so a ticket number can be
+    routed with a bisect instead of a file read and a scan. 1st-level folders are named "name a-b" and 2nd-level ones
+    "a-b"; a 2nd-level range is clipped to its parent's, since a ticket is only ever looked for under the 1st-level
+    folder whose range contains it.
+    """
+
+    def __init__(self):
+        self.cache = None
+        self.starts: list[int] = []
+        self.ranges: list[tuple] = []  # (start, end, folder id, folder name), in the same order as starts
+        self.lock = threading.Lock()
+
+    def _add(self, name_1st_lvl: str, name_2nd_lvl: str, id_2nd_lvl: str):
+        try:
+            start_1st, end_1st = parse_range(name_1st_lvl.split(' ')[1])
+            start, end = parse_range(name_2nd_lvl)
+        except (IndexError, ValueError):
+            logger.warning(f'Ignoring container folder "{name_1st_lvl}/{name_2nd_lvl}", its name isn\'t a range')
+            return
+        start, end = max(start, start_1st), min(end, end_1st)
+        if start > end:
+            return
+        i = bisect.bisect_left(self.starts, start)
+        self.starts.insert(i, start)
+        self.ranges.insert(i, (start, end, id_2nd_lvl, name_2nd_lvl))
+
+    def load(self):
+        """Build the index from folder_cache.json, listing the containers in Drive first if there's no cache yet"""
+        with self.lock:
+            cache_container_folders()
+            with open(FOLDER_CACHE, 'r', encoding='utf-8') as infile:
+                self.cache = json.load(infile)
+            self.starts, self.ranges = [], []
+            for name_1st_lvl, val_1st_lvl in self.cache.items():
+                for name_2nd_lvl, id_2nd_lvl in val_1st_lvl.get('folders').items():
+                    self._add(name_1st_lvl, name_2nd_lvl, id_2nd_lvl)
+
+    def _find(self, ticket_int: int):
+        i = bisect.bisect_right(self.starts, ticket_int) - 1
+        if i >= 0 and ticket_int <= self.ranges[i][1]:
+            return self.ranges[i]
+        return None
+
+    def refresh(self, ticket_int: int = None):
+        """
+        Pick up container folders created in Drive since the index was built. Only 1st-level folders that are new, or
+        whose range covers ticket_int, are re-listed.
+        """
+        with self.lock:
+            tickets_l1 = list_container_folders(CONTAINER_ROOT)
+            for name_1st_lvl, id_1st_lvl in tickets_l1.items():
+                known = self.cache.get(name_1st_lvl)
+                if known and ticket_int is not None:
+                    try:
+                        start_1st, end_1st = parse_range(name_1st_lvl.split(' ')[1])
+                    except (IndexError, ValueError):
+                        continue
+                    if not start_1st <= ticket_int <= end_1st:
+                        continue
+                elif known:
+                    continue
+                folders = list_container_folders(id_1st_lvl)
+                known_folders = known.get('folders') if known else {}
+                for name_2nd_lvl, id_2nd_lvl in folders.items():
+                    if name_2nd_lvl not in known_folders:
+                        logger.info(f'Found new container folder "{name_1st_lvl}/{name_2nd_lvl}"')
+                        self._add(name_1st_lvl, name_2nd_lvl, id_2nd_lvl)
+                self.cache[name_1st_lvl] = {'id': id_1st_lvl, 'folders': folders}
+            with log.file_lock:
+                with open(FOLDER_CACHE, 'w', encoding='utf-8') as outfile:
+                    json.dump(obj=self.cache, fp=outfile)
+
+    def lookup(self, ticket_int: int):
+        """:return: id of the 2nd-level container folder for this ticket number, or None"""
+        if self.cache is None:
+            self.load()
+        found = self._find(ticket_int)
+        if found is None:
+            self.refresh(ticket_int)
+            found = self._find(ticket_int)
+        if found is None:
+            return None
+        logger.debug(f'Folder destination for ticket {ticket_int}: "{found[3]}" {found[2]}')
+        return found[2]
+
+
+containers = ContainerIndex()
+
+
+class DestinationCache:
+    """
+    Folder ids in the shared drive by (parent id, name), filled from the folders we create and list and kept in the
+    state store between runs, so a retried ticket doesn't have to list or re-create its structure
+    """
+
+    def children(self, parent_id: str):
+        """:return: {name: id} of the folders known to be under parent_id"""
+        return state.dest_folders(parent_id)
+
+    def add(self, parent_id: str, folders: dict):
+        state.cache_dest_folders(parent_id, folders)
+
+    def list(self, parent_id: str):
+        """List the folders under parent_id in Drive, and remember them"""
+        folders = dc.get_structure(parent_id)
+        self.add(parent_id, folders)
+        return folders
+
+    def structure(self, parent_id: str, names: list, preexisting: bool = False):
+        """
+        :param names: folders there should be under parent_id. Missing ones are created, with one batch request.
+        :param preexisting: parent_id was made by an earlier run, so folders it created that aren't cached (it died
+            in between) may still be in Drive. If any are missing, parent_id is listed before creating anything.
+        :return: {name: id} for every one of names
+        """
+        known = self.children(parent_id)
+        missing = [name for name in names if name not in known]
+        if missing and preexisting:
+            known.update(self.list(parent_id))
+            missing = [name for name in names if name not in known]
+        if missing:
+            created = dc.create_folders(missing, parent_id)
+            self.add(parent_id, created)
+            known.update(created)
+        return {name: known.get(name) for name in names}
+
+
+destinations = DestinationCache()
+
+
 def get_ticket_destination(ticket_num_str: str):
     """New folders are placed in top-level numbered folders in the team drive; find which one a new item will go into"""
-    cache_container_folders()
-    with open('folder_cache.json', 'r', encoding='utf-8') as infile:
-        cache = json.load(infile)
-    ticket_int = int(ticket_num_str)
-    for name_1st_lvl, val_1st_lvl in cache.items():
-        folder_boundaries = name_1st_lvl.split(' ')[1].split('-')
-        if int(folder_boundaries[0]) <= ticket_int <= int(folder_boundaries[1]):
-            first_lvl_folder = cache[name_1st_lvl]
-            for name_2nd_level, id_2nd_level in first_lvl_folder.get('folders').items():
-                folder_boundaries = name_2nd_level.split('-')
-                if int(folder_boundaries[0]) <= ticket_int <= int(folder_boundaries[1]):
-                    logger.debug(f'Folder destination for ticket {ticket_num_str}: "{name_2nd_level}" {id_2nd_level}')
-                    return id_2nd_level
-                else:
-                    continue
-        else:
-            continue
+    return containers.lookup(int(ticket_num_str))
 
 
 class Folder:
+    # there's one Subfolder per folder in a ticket's tree, so they get slots instead of a __dict__ each
+    __slots__ = ('name', 'id', 'dc', 'tree', 'dest_folder_id', 'ticket_id', 'resumed')
 
-    def __init__(self, folder_name: str, folder_id: str, drive_client: DriveClient):
+    def __init__(self, folder_name: str, folder_id: str, drive_client: DriveClient, tree: TreeSnapshot = None):
+        """:param tree: snapshot of the source tree to plan from, instead of listing every folder through the API"""
         self.name = folder_name
         self.id = folder_id
         self.dc = drive_client
+        self.tree = tree
         self.dest_folder_id: [str, None] = None
+        self.ticket_id: [str, None] = None  # source id of the ticket folder this is in, for the state store
+        self.resumed = False  # an earlier run already started on this folder, so check the state store under it
+
+    @property
+    def dest_path(self):
+        """where this folder ends up, relative to its container folder in the shared drive"""
+        return self.name
+
+    def list_children(self, fields: str = DEFAULT_FIELDS):
+        if self.tree is not None:
+            return self.tree.children_of(self.id)
+        return list(self.dc.iter_files(self.id, fields=fields))
+
+    def iter_children(self, fields: str = DEFAULT_FIELDS):
+        """Like list_children, but a page at a time, so the caller never holds the whole listing"""
+        if self.tree is not None:
+            return iter(self.tree.children_of(self.id))
+        return self.dc.iter_files(self.id, fields=fields)
 
 
 class NewTicketFolder(Folder):
 
-    def __init__(self, folder_name: str, ntf_id: str, drive_client: DriveClient, preexisting: bool = False):
+    def __init__(self, folder_name: str, ntf_id: str, drive_client: DriveClient, preexisting: bool = False,
+                 dry_run: bool = False):
         super().__init__(folder_name, ntf_id, drive_client)
-        if preexisting:
-            self.structure = drive_client.get_structure(folder_id=ntf_id)
+        if dry_run:
+            self.structure = {subfolder_name: None for subfolder_name in STRUCTURE}
         else:
-            logger.info(f'Creating structure under new ticket folder {ntf_id}...')
-            self.structure = {subfolder_name: self.dc.create_folder(name=subfolder_name, parent=ntf_id)
-                              for subfolder_name in STRUCTURE}
+            if not preexisting:
+                logger.info(f'Creating structure under new ticket folder {ntf_id}...')
+            self.structure = destinations.structure(ntf_id, STRUCTURE, preexisting=preexisting)
 
 
 class OriginalTicketFolder(Folder):
 
-    def __init__(self, folder_name: str, folder_id: str, drive_client: DriveClient, new_folder_id: str = None):
-        """:param new_folder_id: for when we already created a folder in the shared drive (i.e. this is a retry)"""
-        super().__init__(folder_name, folder_id, drive_client)
+    def __init__(self, folder_name: str, folder_id: str, drive_client: DriveClient, new_folder_id: str = None,
+                 tree: TreeSnapshot = None, dry_run: bool = False):
+        """
+        :param new_folder_id: for when we already created a folder in the shared drive (i.e. this is a retry)
+        :param dry_run: don't create anything, just work out where things would go (see plan_one)
+        """
+        super().__init__(folder_name, folder_id, drive_client, tree)
+        self.ticket_id = folder_id
         self.SKIP = False
         try:
             self.ticket_number = self.name.split('#')[1].split()[0]
         except IndexError:
             logger.warning(f'The title of folder {folder_id} is malformed and I can\'t determine where it goes. '
                            'Please migrate this folder manually.')
-            with open('err.txt', 'a') as errfile:
+            with locked_append('err.txt') as errfile:
                 traceback.print_exc(file=errfile)
                 errfile.write('='*40)
             self.SKIP = True
             return
         self.division_folder_id = get_ticket_destination(self.ticket_number)  # "1-50", etc
         self.contains_utf_files = False
-        if new_folder_id:
+        if dry_run:
+            self.new_folder = NewTicketFolder(folder_name=folder_name, ntf_id=None, drive_client=self.dc,
+                                              dry_run=True)
+        elif new_folder_id:
             self.dest_folder_id = new_folder_id
+            self.resumed = True
             self.new_folder = NewTicketFolder(folder_name=folder_name, ntf_id=self.dest_folder_id,
                                               drive_client=self.dc, preexisting=True)
             logger.info(f'Retrying migration for {folder_name}')
@@ -106,68 +300,212 @@ class OriginalTicketFolder(Folder):
             self.new_folder = NewTicketFolder(folder_name=folder_name, ntf_id=self.dest_folder_id,
                                               drive_client=self.dc)
 
-    def migrate_single_file(self, file_id: str):
-        self.dc.move_files_location(old_folder=self.id, new_folder=self.new_folder.id,
-                                    file_list=[file_id])
+    def migrate_files(self, file_ids: list):
+        """Move files lying loose in the ticket folder into the new one, a batch request at a time"""
+        for i in range(0, len(file_ids), MAX_BATCH_SIZE):
+            moved = self.dc.move_files_location(old_folder=self.id, new_folder=self.new_folder.id,
+                                                file_list=file_ids[i:i + MAX_BATCH_SIZE])
+            state.record_files(self.id, moved)
 
 
 class Subfolder(Folder):
+    __slots__ = ('parent', 'checkpoint', 'is_empty')
 
     def __init__(self, folder_name: str, folder_id: str, parent: Folder, drive_client: DriveClient):
         """
         :param folder_name: name of this folder
         :param folder_id: id of this folder
-        :param parent: parent Folder instance
+        :param parent: parent Folder instance; its snapshot, if any, is used for this folder too
         """
-        super().__init__(folder_name, folder_id, drive_client)
-        self.files = []
-        self.dest_folder_id = None
+        super().__init__(folder_name, folder_id, drive_client, parent.tree)
         self.parent = parent
+        self.ticket_id = parent.ticket_id
+        self.checkpoint: [dict, None] = None  # this folder's row in the state store, from an earlier run
+        self.is_empty = True  # whether listing it found nothing to migrate
+
+    @property
+    def dest_path(self):
+        return f'{self.parent.dest_path}/{self.name}'
 
     def get_queue(self):
-        """Get queue of folders and files to re-create/move"""
+        """
+        Get queue of folders and files to re-create/move. The listing is consumed as it's fetched, and only the ids
+        (and subfolder names) are kept.
+        """
         if not self.dest_folder_id:
             raise Exception(f'Cannot get queue for a folder that has not been copied yet ({self.name})')
         folder_queue: list[Subfolder] = []
-        files_queue: list[dict] = []
-        is_empty = True
-        self.files = dc.list_files(self.id).get('files')
-        if self.files:
-            is_empty = False
-            for subfile_object in self.files:
-                if subfile_object.get('mimeType') == 'application/vnd.google-apps.folder':
-                    folder_queue.append(Subfolder(folder_name=subfile_object.get('name'),
-                                                  folder_id=subfile_object.get('id'),
-                                                  parent=self,
-                                                  drive_client=self.dc))
-                else:
-                    files_queue.append(subfile_object.get('id'))
-        return is_empty, folder_queue, files_queue
+        files_queue: list[str] = []
+        for subfile_object in self.iter_children():
+            if subfile_object.get('mimeType') == FOLDER_MIMETYPE:
+                folder_queue.append(Subfolder(folder_name=subfile_object.get('name'),
+                                              folder_id=subfile_object.get('id'),
+                                              parent=self,
+                                              drive_client=self.dc))
+            else:
+                files_queue.append(subfile_object.get('id'))
+        return not (folder_queue or files_queue), folder_queue, files_queue
 
-    def migrate(self):
+    def _migrate_node(self):
+        """
+        Re-create this folder under its parent's destination, move its files, and return its subfolders.
+        Runs on a worker thread; the parent's dest_folder_id always exists by the time this is submitted.
+
+        Every step is checkpointed in the state store, so a resumed run reuses the destination folder, skips files
+        that were already dealt with, and never visits subtrees that were finished.
+        """
+        if self.checkpoint:
+            self.resumed = True
+            self.dest_folder_id = self.dest_folder_id or self.checkpoint.get('new_id')
+        if not self.dest_folder_id:
+            self.dest_folder_id = self.dc.create_folder(name=self.name, parent=self.parent.dest_folder_id)
+            state.record_folder(self.id, self.dest_folder_id, self.ticket_id)
+        elif not self.checkpoint:
+            state.record_folder(self.id, self.dest_folder_id, self.ticket_id)
+        self.is_empty, folder_queue, files_queue = self.get_queue()
+        if files_queue and self.resumed:
+            moved = state.moved_files(self.id)  # copied and trashed files are still here
+            files_queue = [file_id for file_id in files_queue if file_id not in moved]
+        for i in range(0, len(files_queue), MAX_BATCH_SIZE):
+            moved = self.dc.move_files_location(old_folder=self.id, new_folder=self.dest_folder_id,
+                                                file_list=files_queue[i:i + MAX_BATCH_SIZE])
+            state.record_files(self.id, moved)
+        return self._resume_subfolders(folder_queue)
+
+    def _resume_subfolders(self, subfolders: list):
+        """
+        If this folder was resumed, attach each subfolder's checkpoint and leave out the finished ones. A subfolder
+        without a checkpoint may still have been created just before the earlier run died, so it's looked for by name
+        in this folder's destination (one listing, only when needed) rather than created a second time.
+        """
+        if not self.resumed or not subfolders:
+            return subfolders
+        checkpoints = state.get_folders([subfolder.id for subfolder in subfolders])
+        existing = None
+        remaining = []
+        for subfolder in subfolders:
+            subfolder.checkpoint = checkpoints.get(subfolder.id)
+            if subfolder.checkpoint is None:
+                if existing is None:
+                    existing = destinations.list(self.dest_folder_id)
+                subfolder.dest_folder_id = existing.pop(subfolder.name, None)
+                subfolder.resumed = subfolder.dest_folder_id is not None
+            elif subfolder.checkpoint.get('status') == FOLDER_DONE:
+                continue
+            remaining.append(subfolder)
+        return remaining
+
+    def _plan_node(self, plan: 'MigrationPlan'):
+        """Record what migrating this folder would do and return its subfolders; the dry-run twin of _migrate_node"""
+        items = plan.list(self)
+        self.is_empty = not items
+        subfolders = []
+        for item in items:
+            if item.get('mimeType') == FOLDER_MIMETYPE:
+                subfolder = Subfolder(folder_name=item.get('name'), folder_id=item.get('id'), parent=self,
+                                      drive_client=self.dc)
+                plan.add_folder(subfolder.dest_path)
+                subfolders.append(subfolder)
+        plan.add_files([item for item in items if item.get('mimeType') != FOLDER_MIMETYPE])
+        return subfolders
+
+    @staticmethod
+    def walk_trees(roots: list, node_task, max_workers: int = None, on_complete=None):
+        """
+        Run node_task, which returns a folder's subfolders to visit next, over several folder trees on one pool
+
+        :param on_complete: called on the calling thread with each folder once everything under it is done
+        """
+        outstanding: dict[Subfolder, int] = {}  # folder -> subfolders not complete yet
+        root_set = set(roots)
+
+        def complete(folder: Subfolder):
+            while True:
+                if on_complete:
+                    on_complete(folder)
+                if folder in root_set:
+                    return
+                folder = folder.parent
+                outstanding[folder] -= 1
+                if outstanding[folder]:
+                    return
+                del outstanding[folder]
+
+        max_workers = max_workers or MIGRATION_WORKERS
+        frontier = deque(roots)  # folders whose parent's task is done, waiting for a worker
+        pending = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            while frontier or pending:
+                # newest first, so the walk is depth first and the frontier stays small
+                while frontier and len(pending) < max_workers * 2:
+                    folder = frontier.pop()
+                    pending[executor.submit(node_task, folder)] = folder
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    folder = pending.pop(future)
+                    subfolders = future.result()
+                    if not subfolders:
+                        complete(folder)
+                        continue
+                    outstanding[folder] = len(subfolders)
+                    frontier.extend(subfolders)
+
+    def _pending(self):
+        """:return: whether this folder's tree still needs migrating, i.e. an earlier run didn't finish it"""
         if not self.dest_folder_id:
             raise Exception(f'Cannot move files from a folder that has not been copied yet ({self.name})')
-        is_empty, folder_queue, files_queue = self.get_queue()
+        if self.parent.resumed and self.checkpoint is None:
+            self.checkpoint = state.get_folder(self.id)
+        if self.checkpoint and self.checkpoint.get('status') == FOLDER_DONE:
+            logger.info(f'"{self.dest_path}" was already migrated')
+            return False
+        return True
 
-        if is_empty:
+    def migrate(self, max_workers: int = None):
+        """
+        Re-create this folder's tree at its destination, see migrate_trees
+
+        :param max_workers: concurrent Drive calls; defaults to MIGRATION_WORKERS
+        """
+        Subfolder.migrate_trees([self], max_workers)
+
+    @staticmethod
+    def migrate_trees(folders: list, max_workers: int = None):
+        """Re-create several folders' trees at their destinations on one pool"""
+        Subfolder._migrate_trees([folder for folder in folders if folder._pending()], max_workers)
+
+    def _migrate_tree(self, max_workers: int = None):
+        Subfolder._migrate_trees([self], max_workers)
+
+    @staticmethod
+    def _migrate_trees(roots: list, max_workers: int = None):
+        """Walk the trees with _migrate_node, creating each root first if it has no destination yet"""
+        if not roots:
             return
-        self.dc.move_files_location(old_folder=self.id, new_folder=self.dest_folder_id, file_list=files_queue)
-        files_queue.clear()
-
-        while folder_queue:
-            current_subfolder = folder_queue.pop(0)
-            current_subfolder.dest_folder_id = self.dc.create_folder(name=current_subfolder.name,
-                                                                     parent=current_subfolder.parent.dest_folder_id)
-            tmp_is_empty, tmp_folder_queue, tmp_files_queue = current_subfolder.get_queue()
-            if tmp_is_empty:
-                continue
+        completed = []  # ids, not folders, so finished subtrees can be freed
 
-            if tmp_files_queue:
-                self.dc.move_files_location(old_folder=current_subfolder.id,
-                                            new_folder=current_subfolder.dest_folder_id,
-                                            file_list=tmp_files_queue)
-            if tmp_folder_queue:
-                folder_queue.extend(tmp_folder_queue)
+        def mark_done():
+            # a folder isn't done until the copy fallbacks it queued are, or a resumed run would skip them
+            wait_for_copies()
+            state.set_folders_status(completed, FOLDER_DONE)
+            completed.clear()
+
+        def on_complete(folder: Subfolder):
+            completed.append(folder.id)
+            if len(completed) >= DONE_CHUNK_SIZE:
+                mark_done()
+
+        Subfolder.walk_trees(roots, Subfolder._migrate_node, max_workers, on_complete=on_complete)
+        mark_done()
+
+    def plan(self, plan: 'MigrationPlan', max_workers: int = None):
+        """Walk this folder's tree like migrate does, but only record the work into plan"""
+        Subfolder.plan_trees([self], plan, max_workers)
+
+    @staticmethod
+    def plan_trees(folders: list, plan: 'MigrationPlan', max_workers: int = None):
+        """Walk several folders' trees on one pool like migrate_trees does, but only record the work into plan"""
+        Subfolder.walk_trees(folders, lambda folder: folder._plan_node(plan), max_workers)
 
     def delete(self):
         pass
@@ -188,66 +526,940 @@ class StructureSubfolder(Subfolder):
         self.folder_map = {}
         self.parent = parent_object
 
+    @property
+    def dest_path(self):
+        return f'{self.parent.dest_path}/{FOLDER_MAP.get(self.name, "redacted")}'
+
+
+class MigrationPlan:
+    """
+    What a migration would do, gathered by walking the source tree without creating, moving or updating anything,
+    and an estimate of the API calls and time it would take
+    """
+
+    def __init__(self, drive_permissions: list = None):
+        """
+        :param drive_permissions: permissions on the destination shared drive (see DriveClient.list_permissions),
+            used to predict which files are owned by non-members and will need the copy fallback
+        """
+        self.lock = threading.Lock()
+        self.tickets = 0
+        self.skipped: list[str] = []  # names of ticket folders migrate_one would skip
+        self.folders: list[str] = []  # destination paths of the folders to create, FOLDER_MAP renames applied
+        self.files = 0
+        self.trashed = 0  # can't be moved into a shared drive, will stay behind
+        self.copy_fallbacks = 0
+        self.move_requests = 0
+        self.list_calls = 0
+        self.zendesk_comments = 0
+        self.latencies: list[float] = []  # seconds per list call, as measured while planning
+        drive_permissions = drive_permissions or []
+        self.check_owners = bool(drive_permissions)
+        self.member_emails = {perm.get('emailAddress').lower() for perm in drive_permissions
+                              if perm.get('emailAddress')}
+        self.member_domains = {perm.get('domain').lower() for perm in drive_permissions
+                               if perm.get('type') == 'domain' and perm.get('domain')}
+
+    def list(self, folder: Folder):
+        """List a folder the way the migration would, timing the calls if they actually go to Drive"""
+        start = time.monotonic()
+        items = folder.list_children(fields=PLAN_FIELDS)
+        elapsed = time.monotonic() - start
+        if folder.tree is None:
+            calls = max(1, math.ceil(len(items) / PAGE_SIZE))
+            with self.lock:
+                self.list_calls += calls
+                self.latencies.append(elapsed / calls)
+        return items
+
+    def add_ticket(self, otf: 'OriginalTicketFolder'):
+        with self.lock:
+            self.tickets += 1
+            self.folders.append(otf.dest_path)
+            self.folders.extend(f'{otf.dest_path}/{subfolder_name}' for subfolder_name in STRUCTURE)
+
+    def add_folder(self, dest_path: str):
+        with self.lock:
+            self.folders.append(dest_path)
+
+    def _needs_copy(self, item: dict):
+        if not self.check_owners or not item.get('owners'):
+            return False
+        for owner in item.get('owners'):
+            email = (owner.get('emailAddress') or '').lower()
+            if email in self.member_emails or email.split('@')[-1] in self.member_domains:
+                return False
+        return True
+
+    def add_files(self, items: list, batched: bool = True):
+        """:param batched: whether move_files_location gets them all at once, or one call per file"""
+        with self.lock:
+            self.files += len(items)
+            self.trashed += sum(1 for item in items if item.get('trashed'))
+            self.copy_fallbacks += sum(1 for item in items if not item.get('trashed') and self._needs_copy(item))
+            self.move_requests += math.ceil(len(items) / MAX_BATCH_SIZE) if batched else len(items)
+
+    def estimate(self, max_workers: int = None, workers: int = 1):
+        """
+        :param max_workers: concurrent Drive calls per ticket, as in Subfolder.migrate
+        :param workers: worker processes, as in migrate_all
+        :return: dict of API call counts and the estimated wall-clock seconds. Time is whichever is slowest of
+            latency (calls * measured latency / concurrency), the Drive quota and the Zendesk quota.
+        """
+        concurrency = (max_workers or MIGRATION_WORKERS) * workers
+        latency = sum(self.latencies) / len(self.latencies) if self.latencies else DEFAULT_CALL_LATENCY
+        creates = len(self.folders)
+        # every ticket's STRUCTURE folders are created with one batch request
+        create_requests = creates - self.tickets * len(STRUCTURE) + self.tickets * min(len(STRUCTURE), 1)
+        # each copy fallback is one copy, straight into the destination; every ticket also gets deleted, and verified
+        # first with at least one listing of each of its trees
+        verify_calls = self.tickets * 2 if VERIFY_BEFORE_DELETE else 0
+        drive_requests = (self.list_calls + create_requests + self.move_requests + self.copy_fallbacks
+                          + self.tickets + verify_calls)
+        # batches count once per request in them
+        drive_quota_units = (self.list_calls + creates + self.files + self.copy_fallbacks + self.tickets
+                             + verify_calls)
+        zendesk_requests = math.ceil(self.tickets / zd.UPDATE_MANY_LIMIT)
+        seconds = max(drive_requests * latency / concurrency,
+                      drive_quota_units / throttle.DRIVE_RATE,
+                      self.copy_fallbacks / throttle.COPY_RATE,
+                      zendesk_requests / throttle.ZENDESK_RATE)
+        return {'drive_requests': drive_requests, 'drive_quota_units': drive_quota_units,
+                'folder_creates': creates, 'move_requests': self.move_requests, 'list_calls': self.list_calls,
+                'zendesk_requests': zendesk_requests, 'latency_per_call': round(latency, 4),
+                'concurrency': concurrency, 'seconds': round(seconds, 1)}
+
+    def summary(self, max_workers: int = None, workers: int = 1):
+        return {'tickets': self.tickets, 'skipped': self.skipped, 'folders_to_create': len(self.folders),
+                'files_to_move': self.files, 'trashed_files': self.trashed, 'copy_fallbacks': self.copy_fallbacks,
+                'zendesk_updates': self.tickets, 'zendesk_comments': self.zendesk_comments,
+                'estimate': self.estimate(max_workers, workers)}
+
+
+def migrate_one(folder_object: dict, retry: bool = False, new_folder_id: str = None, max_workers: int = None):
+    """
+    Move a ticket folder's contents into the shared drive, then queue its Zendesk update and source deletion for
+    the PostMigrationStage
+
+    :param retry: the ticket folder was already re-created in the shared drive as new_folder_id. Tickets the state
+        store knows about are always retried, whatever this says.
+    :param max_workers: concurrent Drive calls for this ticket, see Subfolder.migrate
+    """
+    start = time.monotonic()
+    row = state.get(folder_object.get('id'))
+    if row and row.get('status') == FILES_MOVED and state.get_post_migration(row.get('old_id')):
+        logger.info(f'"{row.get("name")}" ({row.get("old_id")}) is already queued for its Zendesk update')
+        return
+    if row and row.get('new_id') and not new_folder_id:
+        retry, new_folder_id = True, row.get('new_id')
 
-def migrate_one(folder_object: dict, retry: bool = False, new_folder_id: str = None):
     if retry and new_folder_id:
+        # part of this ticket was already moved, so the snapshot (if there is one) is out of date
         otf = OriginalTicketFolder(folder_name=folder_object.get('name'), folder_id=folder_object.get('id'),
                                    drive_client=dc, new_folder_id=new_folder_id)
     else:
         otf = OriginalTicketFolder(folder_name=folder_object.get('name'), folder_id=folder_object.get('id'),
-                                   drive_client=dc)
+                                   drive_client=dc, tree=snapshot)
         if otf.SKIP:
             logger.warning(f'Migration for {folder_object.get("name")} was skipped!')
+            metrics.count('tickets_skipped')
+            return
+        state.record_created(otf.id, otf.new_folder.id, otf.ticket_number, otf.name)
+
+    utf_moved = False  # whether anything was moved into the 'redacted' structure folder
+    if row and row.get('status') == FILES_MOVED:
+        logger.info(f'Files for "{otf.name}" ({otf.id}) were already moved')
+    else:
+        logger.info(f'Starting migration for "{otf.name}" ({otf.id})')
+        otf_files = otf.list_children()  # listed up front, since we're emptying the folder as we go
+        moved = state.moved_files(otf.id) if otf.resumed else set()
+        otf.migrate_files([subitem.get('id') for subitem in otf_files
+                           if subitem.get('mimeType') != FOLDER_MIMETYPE and subitem.get('id') not in moved])
+        structure_folders = [StructureSubfolder(folder_name=subitem.get('name'), folder_id=subitem.get('id'),
+                                                parent_object=otf, drive_client=dc)
+                             for subitem in otf_files if subitem.get('mimeType') == FOLDER_MIMETYPE]
+        Subfolder.migrate_trees(structure_folders, max_workers)
+        for subf in structure_folders:
+            subf.delete()
+            if FOLDER_MAP.get(subf.name, 'redacted') == 'redacted' and not subf.is_empty:
+                utf_moved = True
+        wait_for_copies()
+
+    # a resumed ticket may have had things moved into the UTF folder by an earlier run; the queue checks in Drive
+    utf_folder = otf.new_folder.structure.get('redacted') if otf.resumed and not utf_moved else None
+    state.queue_post_migration(otf.id, otf.ticket_number, otf.new_folder.id, comment=utf_moved,
+                               check_folder=utf_folder)
+    metrics.ticket_done(time.monotonic() - start)
+
+
+def start_copy_pipeline(owner_permission_id: str = OWNER_PERMISSION_ID):
+    """Send copy fallbacks through a CopyPipeline, recording each old -> new id in the state store when it's done"""
+    global copies
+
+    def record_copy(folder_id: str, file_id: str, new_id: str):
+        state.record_files(folder_id, {file_id: new_id})
+
+    copies = CopyPipeline(dc, on_copied=record_copy, owner_permission_id=owner_permission_id)
+    dc.set_copy_pipeline(copies)
+    return copies
+
+
+def wait_for_copies():
+    if copies is not None:
+        copies.wait()
+
+
+def stop_copy_pipeline():
+    global copies
+    if copies is not None:
+        dc.set_copy_pipeline(None)
+        copies.close()
+        copies = None
+
+
+class PostMigrationStage:
+    """Works the queue migrate_one leaves in the state store on a thread of its own: Zendesk updates, then deletions"""
+
+    def __init__(self, drive_client: DriveClient, zendesk_client: zd.ZendeskClient, max_workers: int = POST_WORKERS,
+                 batch_size: int = None, linger: float = POST_LINGER, poll_interval: float = POST_POLL_INTERVAL):
+        """
+        :param max_workers: concurrent Drive calls for the UTF folder checks and source deletions
+        :param batch_size: tickets per Zendesk update_many call; defaults to the client's
+        :param linger: seconds a queued ticket may wait for a full batch before a smaller one is sent
+        :param poll_interval: seconds between looks at the queue when there's nothing to do
+        """
+        self.dc = drive_client
+        self.zd = zendesk_client
+        self.max_workers = max_workers
+        self.batch_size = batch_size or zendesk_client.batch_size
+        self.linger = linger
+        self.poll_interval = poll_interval
+        self._stop = threading.Event()
+        self._drain = True
+        self._thread = None
+        self._executor = None
+
+    def start(self):
+        self._stop.clear()
+        self._drain = True
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='post-migration')
+        self._thread = threading.Thread(target=self._run, name='post-migration', daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self, drain: bool = True, timeout: float = None):
+        """
+        :param drain: send whatever is due first, without waiting for full batches
+        :param timeout: seconds to drain for; whatever is left stays queued for the next run
+        """
+        self._drain = drain
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._drain = False
+            self._thread.join()
+            self._thread = None
+        if self._executor is not None:
+            self._executor.shutdown()
+            self._executor = None
+        queued = state.post_migration_count()
+        if queued:
+            logger.warning(f'{queued} tickets are still queued for their Zendesk update or source deletion; the next '
+                           'run will pick them up')
+
+    def _run(self):
+        while True:
+            stopping = self._stop.is_set()
+            if stopping and not self._drain:
+                return
+            try:
+                worked = self.run_once(flush=stopping)
+            except Exception:
+                logger.exception('Post-migration stage failed, will look at the queue again shortly')
+                worked = False
+            if not worked:
+                if stopping:
+                    return
+                self._stop.wait(self.poll_interval)
+
+    def run_once(self, flush: bool = False):
+        """:return: whether there was a batch of due tickets to process (a full one, an old one, or any if flush)"""
+        due, oldest = state.post_migration_due()
+        if not due or (not flush and due < self.batch_size and oldest > time.time() - self.linger):
+            return False
+        rows = state.claim_post_migration(self.batch_size, POST_LEASE)
+        if not rows:
+            return False
+        to_update, to_delete = [], []
+        for row in rows:
+            status = (state.get(row.get('old_id')) or {}).get('status')
+            if status == SOURCE_DELETED:
+                state.finish_post_migration([row.get('old_id')])
+            elif status == ZENDESK_UPDATED:
+                to_delete.append(row)  # the update went out, deleting didn't
+            else:
+                to_update.append(row)
+        if to_update:
+            to_delete.extend(self.update_zendesk(to_update))
+        list(self._executor.map(self.delete_source, to_delete))
+        return True
+
+    def _retry(self, rows: list, error):
+        delays = {row.get('old_id'): min(POST_RETRY_BASE * 2 ** row.get('attempts'), POST_RETRY_MAX) for row in rows}
+        state.retry_post_migration(delays, str(error))
+        metrics.count('post_migration_retries', len(rows))
+        logger.warning(f'Will retry {len(rows)} tickets in {min(delays.values()):.0f}s or more: {error}')
+
+    def _utf_check(self, row: dict):
+        """:return: (row, whether its UTF folder has anything in it), or (row, the exception) if it couldn't tell"""
+        try:
+            return row, bool(self.dc.list_files(folder_id=row.get('check_folder'), fields='id',
+                                                page_size=1).get('files'))
+        except Exception as e:
+            return row, e
+
+    def update_zendesk(self, rows: list):
+        """
+        Send the Zendesk updates for rows with one update_many call
+
+        :return: the rows that were sent, which move on to ZENDESK_UPDATED
+        """
+        comments = {row.get('old_id'): bool(row.get('comment')) for row in rows}
+        checks = [row for row in rows if not row.get('comment') and row.get('check_folder')]
+        failed = []
+        # an earlier run may have moved things into the UTF folder already, so ask Drive what's in it
+        for row, found in self._executor.map(self._utf_check, checks):
+            if isinstance(found, Exception):
+                failed.append(row)
+                self._retry([row], found)
+            else:
+                comments[row.get('old_id')] = found
+        rows = [row for row in rows if row not in failed]
+        by_ticket: dict[str, list] = {}  # several source folders can belong to the same ticket
+        for row in rows:
+            by_ticket.setdefault(row.get('ticket_number'), []).append(row)
+        for ticket_number, ticket_rows in by_ticket.items():
+            self.zd.queue_custom_field(ticket_number, ticket_rows[-1].get('new_id'), field_name='Google Drive ID')
+            if any(comments.get(row.get('old_id')) for row in ticket_rows):
+                logger.info(f'Commenting on ticket {ticket_number}')
+                self.zd.queue_internal_comment(ticket_number, ZD_MOVED_COMMENT, vvars.zendesk_user_id)
+        try:
+            sent = set(self.zd.flush())
+        except Exception as e:
+            self.zd.discard()
+            self._retry(rows, e)
+            return []
+        updated = [row for row in rows if str(row.get('ticket_number')) in sent]
+        state.set_statuses([row.get('old_id') for row in updated], ZENDESK_UPDATED)
+        metrics.count('zendesk_updated', len(updated))
+        return updated
+
+    def delete_source(self, row: dict):
+        folder_id = row.get('old_id')
+        if VERIFY_BEFORE_DELETE:
+            try:
+                report = verify_ticket(state.get(folder_id))
+            except Exception as e:
+                self._retry([row], e)
+                return
+            if not report.get('clean'):
+                # the source is all there is of whatever didn't arrive, so keep it until someone has a look
+                logger.warning(f'Not deleting {folder_id} (ticket {report.get("ticket_number")}), its destination '
+                               f'isn\'t verified: {describe_report(report)}')
+                metrics.count('verifications_failed')
+                self._retry([row], f'verification failed: {describe_report(report)}')
+                return
+        try:
+            self.dc.delete_folder(folder_id)
+        except HttpError as httpe:
+            reason = throttle.reason_of(httpe)
+            if reason == 'insufficientFilePermissions':
+                logger.info(f'Could not delete {folder_id} due to insufficient permissions.')
+                state.finish_post_migration([folder_id])
+            elif httpe.resp.status == 404:
+                state.finish_post_migration([folder_id], SOURCE_DELETED)  # already gone
+            else:
+                self._retry([row], httpe)
+            return
+        except Exception as e:
+            self._retry([row], e)
             return
-        with open(IDCSV, 'a', encoding='utf-8') as f:
-            f.write(f'{otf.id},{otf.new_folder.id},"{otf.name}"\n')
-
-    logger.info(f'Starting migration for "{otf.name}" ({otf.id})')
-    otf_files = dc.list_files(otf.id).get('files')
-    for subitem in otf_files:
-        if subitem.get('mimeType') != 'application/vnd.google-apps.folder':
-            otf.migrate_single_file(subitem.get('id'))
-            continue
-
-        subf = StructureSubfolder(folder_name=subitem.get('name'), folder_id=subitem.get('id'),
-                                  parent_object=otf, drive_client=dc)
-        subf.migrate()
-        subf.delete()
-
-    zd.update_custom_field(otf.ticket_number, otf.new_folder.id, field_name='Google Drive ID')
-    utf = dc.list_files(folder_id=otf.new_folder.structure.get('redacted')).get('files')
-    if len(utf) > 0:
-        logger.info(f'Commenting on ticket {otf.ticket_number}')
-        zd.internal_comment_on_ticket(otf.ticket_number, ZD_MOVED_COMMENT, vvars.zendesk_user_id)
-
-    with open('done', 'a', encoding='utf-8') as f2:
-        f2.write(f'{folder_object.get("id")}\n')
+        state.finish_post_migration([folder_id], SOURCE_DELETED)
+        metrics.count('sources_deleted')
+
+
+def start_post_migration():
+    """Start working the post-migration queue in the background, see PostMigrationStage"""
+    global post_migration
+    post_migration = PostMigrationStage(dc, zd.client).start()
+    return post_migration
+
+
+def stop_post_migration(drain: bool = True):
+    global post_migration
+    if post_migration is not None:
+        post_migration.stop(drain=drain, timeout=POST_DRAIN_TIMEOUT)
+        post_migration = None
+
+
+def record_sync_start(token: str = None):
+    """
+    Remember where the changes feed is, unless we already have a place to pick it up from, see sync_changes
+
+    :param token: start page token to record, e.g. one taken with the snapshot we migrate from. Defaults to now.
+    """
+    if state.get_setting(SYNC_TOKEN) is None:
+        state.set_setting(SYNC_TOKEN, token or dc.get_start_page_token())
 
+
+def destination_of(folder_id: str):
+    """Where the contents of a source ticket folder, or a folder in one, have been going; None if it wasn't started"""
+    row = state.get_folder(folder_id) or state.get(folder_id)
+    return row.get('new_id') if row else None
+
+
+def find_ticket_folder(item: dict, root_id: str, ancestry: dict):
+    """
+    :param item: file dict with id and parents
+    :param ancestry: {folder id: its parent's id}, filled as we go so no folder is fetched twice
+    :return: id of the ticket folder (a direct child of root_id) that item is in, or is; None if it's not under root_id
+    """
+    file_id, parent_id = item.get('id'), (item.get('parents') or [None])[0]
+    seen = set()
+    while parent_id and file_id not in seen:
+        if parent_id == root_id:
+            return file_id
+        seen.add(file_id)
+        row = state.get_folder(parent_id)  # folders we migrated know their ticket, no need to walk any further
+        if row:
+            return row.get('ticket_id')
+        if state.get(parent_id):
+            return parent_id
+        if parent_id not in ancestry:
+            try:
+                ancestry[parent_id] = (dc.get_file(parent_id, fields='id, parents').get('parents') or [None])[0]
+            except HttpError:
+                ancestry[parent_id] = None  # gone, or not ours to see
+        file_id, parent_id = parent_id, ancestry[parent_id]
+    return None
+
+
+def sync_item(item: dict, ticket_id: str):
+    """
+    Move a changed file into the migrated copy of its folder, or re-create a changed folder's tree there
+
+    :return: whether anything was migrated. Items whose folder is new too are left to that folder's own change.
+    """
+    parent_id = (item.get('parents') or [None])[0]
+    dest = destination_of(parent_id)
+    if dest is None:
+        return False
+    if item.get('mimeType') == FOLDER_MIMETYPE:
+        if state.get_folder(item.get('id')):
+            return False  # already migrated; anything new in it comes as changes of its own
+        ticket = state.get(parent_id)
+        if ticket:
+            # right in the ticket folder, so it's mapped onto a structure folder like migrate_one does
+            otf = OriginalTicketFolder(folder_name=ticket.get('name'), folder_id=parent_id, drive_client=dc,
+                                       new_folder_id=dest)
+            folder = StructureSubfolder(folder_name=item.get('name'), folder_id=item.get('id'), parent_object=otf,
+                                        drive_client=dc)
+        else:
+            parent = Folder(folder_name=parent_id, folder_id=parent_id, drive_client=dc)
+            parent.dest_folder_id, parent.ticket_id, parent.resumed = dest, ticket_id, True
+            folder = Subfolder(folder_name=item.get('name'), folder_id=item.get('id'), parent=parent, drive_client=dc)
+        folder._migrate_tree()
+    else:
+        if item.get('id') in state.moved_files(parent_id):
+            return False
+        state.record_files(parent_id, dc.move_files_location(old_folder=parent_id, new_folder=dest,
+                                                             file_list=[item.get('id')]))
+    metrics.count('changes_synced')
+    return True
+
+
+def sync_changes(folder_id: str = OLDCASE):
+    """
+    Migrate whatever was added or changed under folder_id since the last run (or sync), going by the Drive changes
+    feed instead of re-listing the whole tree. New ticket folders, and tickets that weren't finished, go through
+    migrate_one; new files and folders in tickets that were already migrated go straight to the migrated copy of the
+    folder they're in. The feed's position is kept in the state store, and only moved on once everything went through.
+
+    :return: number of tickets and items that were migrated
+    """
+    token = state.get_setting(SYNC_TOKEN)
+    if token is None:
+        record_sync_start()
+        logger.info('There was no changes feed position to sync from yet; the next sync will start from now')
+        return 0
+    containers.load()
+    source_drive = dc.get_file(folder_id, fields='id, driveId').get('driveId')  # None for My Drive
+    ancestry = {}
+    tickets = {}  # ticket folder id -> ticket folder dict (None until we need it) for migrate_one
+    items = {}  # id -> (changed item, its ticket folder id) in tickets that were already started
+    new_token = token
+    for changes, new_start_page_token in dc.iter_change_pages(token):
+        for change in changes:
+            item = change.get('file')
+            # our own moves and creates in the shared drive show up here too
+            if change.get('removed') or not item or item.get('trashed') or item.get('driveId') != source_drive:
+                continue
+            ticket_id = find_ticket_folder(item, folder_id, ancestry)
+            if ticket_id is None:
+                continue
+            if ticket_id == item.get('id'):
+                if not state.is_done(ticket_id):
+                    tickets[ticket_id] = item
+                continue
+            if not state.is_done(ticket_id):
+                tickets.setdefault(ticket_id, None)
+            if state.get(ticket_id):
+                items[item.get('id')] = (item, ticket_id)
+        new_token = new_start_page_token or new_token
+    logger.info(f'Changes since the last sync: {len(tickets)} tickets to migrate and {len(items)} items in tickets '
+                'that were already started')
+
+    synced = 0
+    start_copy_pipeline()
+    start_post_migration()
     try:
-        dc.delete_folder(folder_object.get('id'))
-    except HttpError as httpe:
-        err_reason = httpe.error_details[0].get('reason')
-        if err_reason == 'insufficientFilePermissions':
-            logger.info(f'Could not delete {folder_object.get("id")} due to insufficient permissions.')
-
-
-def migrate_all(folder_id: str = OLDCASE):
-    response = dc.list_files(folder_id)
-    while response:
-        file_list = response.get('files')
-        print(len(file_list))
-        with open('done', 'r', encoding='utf-8') as inf:
-            done_files = inf.read().splitlines()
+        for item, ticket_id in items.values():
+            synced += sync_item(item, ticket_id)
+        for ticket_id, fo in tickets.items():
+            if not state.is_done(ticket_id):
+                migrate_one(folder_object=fo or dc.get_file(ticket_id, fields=DEFAULT_FIELDS))
+                synced += 1
+    except BaseException:
+        stop_post_migration(drain=False)
+        raise
+    finally:
+        stop_copy_pipeline()
+    stop_post_migration()
+    state.set_setting(SYNC_TOKEN, new_token)
+    logger.info(f'Sync done: migrated {synced} tickets and items')
+    return synced
+
+
+def diff_ticket(row: dict, source: [TreeSnapshot, None], dest: TreeSnapshot, folders: dict, files: dict):
+    """
+    Compare a ticket's source (None once it's deleted) and the ids recorded as it was migrated against its destination
+
+    :return: missing, misplaced, mismatched, extra and duplicated paths; clean unless any of the first three, or it's
+        unverifiable (the source is gone and there are no recorded ids)
+    """
+    old_root, new_root = row.get('old_id'), row.get('new_id')
+    report = {'ticket_number': row.get('ticket_number'), 'old_id': old_root, 'new_id': new_root,
+              'source_items': len(source) if source is not None else None, 'dest_items': len(dest),
+              'missing': [], 'misplaced': [], 'mismatched': [], 'extra': [], 'duplicated': [], 'trashed': 0}
+    live = {file_id: item for file_id, item in dest.items.items() if not item.get('trashed')}
+    by_name: dict[tuple, list] = {}  # (destination parent id, name) -> items
+    for item in live.values():
+        by_name.setdefault((dest.parent_of(item.get('id')), item.get('name')), []).append(item)
+    dest_of = {old_root: new_root}  # source folder id -> destination folder id
+    matched = set()
+
+    def find_by_name(parent_id: str, name: str, is_folder: bool, md5: str = None):
+        """:return: id of an unmatched destination item with this name (and checksum, if given), or None"""
+        for item in by_name.get((parent_id, name), []):
+            if (item.get('mimeType') == FOLDER_MIMETYPE) != is_folder:
+                continue
+            if not is_folder and item.get('id') in matched:  # FOLDER_MAP can merge folders, but not files
+                continue
+            if md5 and item.get('md5Checksum') and item.get('md5Checksum') != md5:
+                continue
+            return item.get('id')
+        return None
+
+    def check(new_id: str, expected_parent: str, where: str, original: dict = None):
+        """Match a destination item against what should be there"""
+        if new_id not in live:
+            report['missing'].append(where)
+            return
+        matched.add(new_id)
+        if expected_parent is not None and dest.parent_of(new_id) != expected_parent:
+            report['misplaced'].append(f'{where} -> {dest.path(new_id)}')
+        if original:
+            copy = live[new_id]
+            for field in ['md5Checksum', 'size']:
+                if original.get(field) and copy.get(field):
+                    if original.get(field) != copy.get(field):
+                        report['mismatched'].append(where)
+                    break
+
+    if source is not None:
+        for item in source.walk():  # parents before children
+            file_id, where = item.get('id'), source.path(item.get('id'))
+            parent_dest = dest_of.get(source.parent_of(file_id))
+            if item.get('mimeType') == FOLDER_MIMETYPE:
+                name = item.get('name')
+                if source.parent_of(file_id) == old_root:
+                    name = FOLDER_MAP.get(name, 'redacted')
+                new_id = folders.get(file_id) or find_by_name(parent_dest, name, is_folder=True)
+                check(new_id, parent_dest, f'{where}/')
+                if new_id in live:
+                    dest_of[file_id] = new_id
+            elif item.get('trashed'):
+                report['trashed'] += 1  # couldn't be moved, goes with the source
+            else:
+                # still in the source, so it should have been copied
+                new_id = (files.get(file_id) or (None,))[0]
+                if new_id in (None, file_id):
+                    new_id = find_by_name(parent_dest, item.get('name'), False, item.get('md5Checksum'))
+                check(new_id, parent_dest, where, original=item)
+
+    for old_id, (new_id, folder_id) in files.items():
+        if new_id is None or (source is not None and old_id in source):
+            continue  # trashed when we got to it, or already checked above
+        expected_parent = dest_of.get(folder_id) or folders.get(folder_id)
+        folder_path = source.path(folder_id) if source is not None else folder_id
+        check(new_id, expected_parent, f'{folder_path}/{old_id}' if folder_path else old_id)
+
+    duplicates: dict[tuple, list] = {}
+    for file_id, item in live.items():
+        if file_id not in matched:
+            if dest.parent_of(file_id) == new_root and item.get('name') in STRUCTURE:
+                continue  # every ticket gets these, whatever was in the source
+            report['extra'].append(dest.path(file_id))
+        key = (dest.parent_of(file_id), item.get('name'), item.get('mimeType'), item.get('md5Checksum'))
+        duplicates.setdefault(key, []).append(file_id)
+    report['duplicated'] = [dest.path(ids[0]) for ids in duplicates.values() if len(ids) > 1]
+    report['unverifiable'] = source is None and not folders and not files
+    report['clean'] = not (report['unverifiable'] or report['missing'] or report['misplaced'] or report['mismatched'])
+    return report
+
+
+def verify_ticket(row: dict):
+    """
+    Fetch a ticket's source and destination trees at the same time, then diff them, see diff_ticket
+
+    :param row: the ticket's row in the state store
+    """
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        dest_future = executor.submit(dc.snapshot_tree, row.get('new_id'), fields=VERIFY_FIELDS, max_workers=2)
+        source = None
+        if row.get('status') != SOURCE_DELETED:
+            source = dc.snapshot_tree(row.get('old_id'), fields=VERIFY_FIELDS, max_workers=2)
+            if not len(source):  # an empty folder, or one that's gone without the state store knowing
+                try:
+                    dc.get_file(row.get('old_id'), fields='id')
+                except HttpError as httpe:
+                    if httpe.resp.status != 404:
+                        raise
+                    source = None
+        dest = dest_future.result()
+    return diff_ticket(row, source, dest, state.ticket_folders(row.get('old_id')),
+                       state.ticket_files(row.get('old_id')))
+
+
+def describe_report(report: dict):
+    """'2 missing, 1 extra' and so on, with the first few paths of whatever blocks deletion"""
+    if report.get('unverifiable'):
+        return 'unverifiable, the source is gone and there are no recorded ids to check the destination against'
+    counts = [f'{len(report.get(key))} {key}' for key in ['missing', 'misplaced', 'mismatched', 'extra', 'duplicated']
+              if report.get(key)]
+    examples = [path for key in ['missing', 'misplaced', 'mismatched'] for path in report.get(key)][:5]
+    return ', '.join(counts) + (f' (e.g. {examples})' if examples else '') if counts else 'clean'
+
+
+def verify_all(workers: int = VERIFY_WORKERS, path: str = 'verification.json'):
+    """
+    Verify every migrated ticket, and write the ones that aren't clean to path with a summary of the run
+
+    :param workers: tickets to verify at once
+    :return: reports of the tickets that aren't clean
+    """
+    state.import_legacy(idcsv=IDCSV, done='done')
+    tickets = [row for row in state.tickets() if row.get('new_id')
+               and row.get('status') in [FILES_MOVED, ZENDESK_UPDATED, SOURCE_DELETED]]
+    logger.info(f'Verifying {len(tickets)} tickets...')
+    summary = {'tickets': len(tickets), 'clean': 0, 'not_clean': 0, 'unverifiable': 0, 'errors': 0}
+    problems = []
+
+    def verify(row: dict):
+        try:
+            return verify_ticket(row)
+        except Exception as e:
+            return {'ticket_number': row.get('ticket_number'), 'old_id': row.get('old_id'),
+                    'new_id': row.get('new_id'), 'error': str(e), 'clean': False}
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for i, report in enumerate(executor.map(verify, tickets), start=1):
+            if report.get('clean'):
+                summary['clean'] += 1
+            else:
+                if 'error' in report:
+                    summary['errors'] += 1
+                else:
+                    summary['unverifiable' if report.get('unverifiable') else 'not_clean'] += 1
+                problems.append(report)
+            if i % 500 == 0:
+                logger.info(f'Verified {i}/{len(tickets)} tickets: {summary}')
+    with open(path, 'w', encoding='utf-8') as outfile:
+        json.dump(obj={'summary': summary, 'tickets': problems}, fp=outfile, indent=2)
+    logger.info(f'Verification written to {path}: {summary}')
+    return problems
+
+
+def load_snapshot(folder_id: str = OLDCASE, path: str = 'snapshot.json'):
+    """
+    Use a snapshot of the whole source tree instead of listing every folder as we go. It's read from path if it's
+    there, otherwise fetched from Drive and saved to path, so later runs can reuse it or diff against it.
+    """
+    global snapshot
+    if os.path.exists(path):
+        snapshot = TreeSnapshot.load(path)
+        logger.info(f'Loaded snapshot of {snapshot.root_id} with {len(snapshot)} items from {path}')
+        return snapshot
+    logger.info(f'Taking a snapshot of {folder_id}...')
+    token = dc.get_start_page_token()  # anything that changes from here on is in the feed, see record_sync_start
+    snapshot = dc.snapshot_tree(folder_id)
+    snapshot.start_page_token = token
+    snapshot.save(path)
+    logger.info(f'Saved snapshot of {folder_id} with {len(snapshot)} items to {path}')
+    return snapshot
+
+
+def init_worker(lock=None, workers: int = 1, snapshot_path: str = None):
+    """
+    Pool initializer: every worker process gets its own DriveClient, shares the parent's file lock, and takes an
+    even share of the Drive and copy quotas. Workers don't talk to Zendesk; the parent's PostMigrationStage does.
+    """
+    global dc
+    if lock is not None:
+        log.set_file_lock(lock)
+    throttle.drive_throttle.set_rate(throttle.DRIVE_RATE / (workers + 1))  # the parent keeps a share, see migrate_all
+    throttle.copy_throttle.set_rate(throttle.COPY_RATE / workers)
+    dc = DriveClient()
+    start_copy_pipeline()
+    # forked workers start out with the parent's numbers, which the parent already reports itself
+    metrics.reset()
+    metrics_path = os.path.join(METRICS_DIR, f'worker-{os.getpid()}.json')
+    metrics.start_reporter(metrics_path, interval=METRICS_INTERVAL)
+    # finish this worker's copies when the pool shuts it down, then write its last snapshot
+    multiprocessing.util.Finalize(None, stop_copy_pipeline, exitpriority=7)
+    multiprocessing.util.Finalize(None, metrics.stop_reporter, args=(metrics_path,), exitpriority=5)
+    if snapshot_path and snapshot is None:  # forked workers already have the parent's
+        load_snapshot(path=snapshot_path)
+
+
+def pending_ticket_folders(folder_id: str = OLDCASE):
+    """Yield every ticket folder under folder_id that the state store doesn't have as done yet, one page at a time"""
+    for file_list in dc.iter_pages(folder_id, prefetch=True):
+        logger.info(f'Listed {len(file_list)} ticket folders')
         for fo in file_list:
-            if fo.get('id') in done_files:
+            if state.is_done(fo.get('id')):
                 continue
-            migrate_one(folder_object=fo)
-        next_page_token = response.get('nextPageToken', None)
-        if next_page_token:
-            response = dc.list_files(folder_id, next_page_token=next_page_token)
-        else:
-            logger.info("No more files to migrate!")
-            response = None
+            metrics.count('tickets_found')
+            yield fo
+    logger.info("No more files to migrate!")
+
+
+def collect_metrics():
+    """This process's metrics merged with the latest snapshot from every worker process"""
+    return merge([metrics.snapshot()] + read_snapshots(os.path.join(METRICS_DIR, 'worker-*.json')))
+
+
+def start_metrics(metrics_port: int = None, show_progress: bool = None):
+    """
+    Write metrics/metrics.json and a progress line every METRICS_INTERVAL seconds until stop_metrics is called
+
+    :param metrics_port: also serve Prometheus metrics on http://127.0.0.1:metrics_port/metrics
+    :param show_progress: keep a live progress line on stderr; defaults to whether stderr is a terminal
+    """
+    show_progress = sys.stderr.isatty() if show_progress is None else show_progress
+    metrics.start_reporter(os.path.join(METRICS_DIR, 'metrics.json'), interval=METRICS_INTERVAL,
+                           collect=collect_metrics, show_progress=show_progress)
+    if metrics_port is not None:
+        metrics.serve(metrics_port, collect=collect_metrics)
+    return show_progress
+
+
+def stop_metrics(show_progress: bool = False):
+    metrics.stop_reporter(os.path.join(METRICS_DIR, 'metrics.json'), collect=collect_metrics,
+                          show_progress=show_progress)
+
+
+def migrate_all(folder_id: str = OLDCASE, workers: int = 1, max_workers: int = None, snapshot_path: str = None,
+                metrics_port: int = None, show_progress: bool = None):
+    """
+    :param folder_id: folder holding all the ticket folders
+    :param workers: number of processes to shard the ticket folders across. Ticket folders are independent, so
+        each worker migrates whole tickets with its own DriveClient.
+    :param max_workers: concurrent Drive calls per ticket; defaults to MIGRATION_WORKERS
+    :param snapshot_path: plan from a snapshot of the source tree saved here (taken first if it doesn't exist yet)
+    :param metrics_port: serve Prometheus metrics on localhost at this port while migrating, see start_metrics
+    :param show_progress: keep a live progress line on stderr; defaults to whether stderr is a terminal
+    """
+    metrics.reset()
+    for path in glob.glob(os.path.join(METRICS_DIR, 'worker-*.json')):
+        os.remove(path)  # left over from an earlier run
+    state.import_legacy(idcsv=IDCSV, done='done')
+    containers.load()  # fill folder_cache.json once, before any workers start reading it
+    if snapshot_path:
+        load_snapshot(folder_id, snapshot_path)
+        metrics.count('tickets_total', sum(1 for fo in snapshot.children_of(folder_id)
+                                           if not state.is_done(fo.get('id'))))
+        if snapshot.start_page_token is None:
+            logger.warning(f'{snapshot_path} has no changes feed position; anything added to the source after '
+                           'it was taken will only be migrated by a full run, not by sync_changes')
+    # so sync_changes picks up whatever changes while we migrate, or since the snapshot we migrate from was taken
+    record_sync_start(snapshot.start_page_token if snapshot_path else None)
+    # fork the workers before the metrics and post-migration threads start; a child would inherit any lock one of
+    # them holds at that moment, with no thread left to release it
+    pool = start_pool(workers, snapshot_path) if workers > 1 else None
+    drive_rate = throttle.drive_throttle.max_rate
+    if pool is not None:
+        # the post-migration stage verifies and deletes here while the workers migrate, so it takes a share too
+        throttle.drive_throttle.set_rate(throttle.DRIVE_RATE / (workers + 1))
+    show_progress = False
+    try:
+        show_progress = start_metrics(metrics_port, show_progress)
+        start_post_migration()  # also picks up whatever an earlier run left queued
+        try:
+            if pool is None:
+                start_copy_pipeline()
+                try:
+                    for fo in pending_ticket_folders(folder_id):
+                        migrate_one(folder_object=fo, max_workers=max_workers)
+                finally:
+                    stop_copy_pipeline()
+            else:
+                migrate_in_pool(pool, folder_id, max_workers)
+        except BaseException:
+            stop_post_migration(drain=False)
+            raise
+        stop_post_migration()
+    finally:
+        if pool is not None:
+            pool.terminate()  # no-op after migrate_in_pool closed it
+            pool.join()
+            throttle.drive_throttle.set_rate(drive_rate)
+        stop_metrics(show_progress)
+
+
+def start_pool(workers: int, snapshot_path: str = None):
+    """Fork the migration workers, see init_worker. Call it before starting any threads in this process."""
+    lock = multiprocessing.Lock()
+    log.set_file_lock(lock)
+    return multiprocessing.Pool(processes=workers, initializer=init_worker, initargs=(lock, workers, snapshot_path))
+
+
+def migrate_in_pool(pool: multiprocessing.pool.Pool, folder_id: str, max_workers: int = None):
+    try:
+        for _ in pool.imap_unordered(functools.partial(migrate_one, max_workers=max_workers),
+                                     pending_ticket_folders(folder_id)):
+            pass
+        pool.close()
+    except BaseException:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def plan_one(folder_object: dict, plan: MigrationPlan, max_workers: int = None):
+    """The dry-run version of migrate_one: record what migrating this ticket folder would do into plan"""
+    otf = OriginalTicketFolder(folder_name=folder_object.get('name'), folder_id=folder_object.get('id'),
+                               drive_client=dc, tree=snapshot, dry_run=True)
+    if otf.SKIP:
+        plan.skipped.append(otf.name)
+        return
+    plan.add_ticket(otf)
+    items = plan.list(otf)
+    plan.add_files([subitem for subitem in items if subitem.get('mimeType') != FOLDER_MIMETYPE])
+    structure_folders = [StructureSubfolder(folder_name=subitem.get('name'), folder_id=subitem.get('id'),
+                                            parent_object=otf, drive_client=dc)
+                         for subitem in items if subitem.get('mimeType') == FOLDER_MIMETYPE]
+    Subfolder.plan_trees(structure_folders, plan, max_workers)
+    # the same test migrate_one uses for the UTF comment
+    if any(FOLDER_MAP.get(subf.name, 'redacted') == 'redacted' and not subf.is_empty for subf in structure_folders):
+        plan.zendesk_comments += 1
+
+
+def plan_all(folder_id: str = OLDCASE, max_workers: int = None, workers: int = 1, snapshot_path: str = None,
+             path: str = 'plan.json'):
+    """
+    Plan a migration without changing anything: walk every ticket folder migrate_all would, and write the plan
+    (folders to create, files to move, expected copy fallbacks and Zendesk updates, estimated calls and time) to path.
+
+    :param max_workers: concurrency migrate_all will run with, for the time estimate
+    :param workers: worker processes migrate_all will run with, for the time estimate
+    :param snapshot_path: plan from a snapshot of the source tree instead of listing every folder
+    """
+    state.import_legacy(idcsv=IDCSV, done='done')
+    containers.load()
+    if snapshot_path:
+        load_snapshot(folder_id, snapshot_path)
+    plan = MigrationPlan(drive_permissions=dc.list_permissions(NEWCASE))
+    for fo in pending_ticket_folders(folder_id):
+        plan_one(fo, plan, max_workers)
+    if not plan.latencies:
+        # everything came from the snapshot; time a few cheap listings so the estimate has something to go on
+        for _ in range(5):
+            start = time.monotonic()
+            dc.list_files(folder_id, fields='id', page_size=1)
+            plan.latencies.append(time.monotonic() - start)
+    summary = plan.summary(max_workers, workers)
+    with open(path, 'w', encoding='utf-8') as outfile:
+        json.dump(obj=dict(summary, folders=plan.folders), fp=outfile, indent=2)
+    logger.info(f'Migration plan written to {path}: {summary}')
+    return plan
+
+
+def cli(argv: list = None):
+    """
+    Command line entry point. Nothing talks to Google until a command needs it: importing this module is free, and the
+    Drive client is only built (and authenticated) on first use.
+    """
+    import argparse
+    from drive_service import get_creds
+
+    parser = argparse.ArgumentParser(description='Migrate ticket folders from a shared folder into a shared drive')
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    migrate = commands.add_parser('migrate', help='migrate every ticket folder that isn\'t done yet')
+    migrate.add_argument('--folder', default=OLDCASE, help='folder holding the ticket folders')
+    migrate.add_argument('--workers', type=int, default=1, help='worker processes to shard the tickets across')
+    migrate.add_argument('--max-workers', type=int,
+                         help=f'concurrent Drive calls per ticket (default {MIGRATION_WORKERS})')
+    migrate.add_argument('--snapshot', help='plan from a snapshot of the source tree saved at this path')
+    migrate.add_argument('--metrics-port', type=int, help='serve Prometheus metrics on localhost at this port')
+    migrate.add_argument('--progress', action=argparse.BooleanOptionalAction, default=None,
+                         help='live progress line on stderr (default: when stderr is a terminal)')
+
+    plan = commands.add_parser('plan', help='work out what a migration would do, without changing anything')
+    plan.add_argument('--folder', default=OLDCASE)
+    plan.add_argument('--workers', type=int, default=1, help='worker processes the migration will run with')
+    plan.add_argument('--max-workers', type=int,
+                      help=f'concurrent Drive calls per ticket (default {MIGRATION_WORKERS})')
+    plan.add_argument('--snapshot')
+    plan.add_argument('--output', default='plan.json')
+
+    sync = commands.add_parser('sync', help='migrate whatever changed since the last run, from the Drive changes feed')
+    sync.add_argument('--folder', default=OLDCASE)
+
+    verify = commands.add_parser('verify', help='check every migrated ticket\'s destination against its source')
+    verify.add_argument('--workers', type=int, default=VERIFY_WORKERS, help='tickets to verify at once')
+    verify.add_argument('--output', default='verification.json')
+
+    commands.add_parser('auth', help='authenticate with Google, or refresh the saved token')
+
+    args = parser.parse_args(argv)
+    if args.command == 'migrate':
+        migrate_all(folder_id=args.folder, workers=args.workers, max_workers=args.max_workers,
+                    snapshot_path=args.snapshot, metrics_port=args.metrics_port, show_progress=args.progress)
+    elif args.command == 'plan':
+        plan_all(folder_id=args.folder, max_workers=args.max_workers, workers=args.workers,
+                 snapshot_path=args.snapshot, path=args.output)
+    elif args.command == 'sync':
+        sync_changes(folder_id=args.folder)
+    elif args.command == 'verify':
+        problems = verify_all(workers=args.workers, path=args.output)
+        return 1 if problems else 0
+    elif args.command == 'auth':
+        get_creds()
+    return 0
 
 
-migrate_all()
+if __name__ == '__main__':
+    sys.exit(cli())
@@ -0,0 +1,302 @@
+import glob
+import json
+import os
+import re
+import sys
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from log import logger
+
+'''
+Instrumentation for the migration hot path: per-method latency histograms, call, error and retry counts, bytes
+transferred and per-ticket durations. It's exported as JSON snapshots written every few seconds, as a Prometheus text
+endpoint on localhost, and as a live progress line with items/sec and an ETA.
+
+Snapshots are plain dicts so worker processes can each write their own and the parent can merge them, see merge.
+'''
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]  # seconds, for API calls
+TICKET_BUCKETS = [1, 5, 15, 30, 60, 120, 300, 600, 1800, 3600]  # seconds, for whole tickets
+SEP = '|'  # joins label values into snapshot keys, e.g. 'drive|files.list'
+
+
+class Histogram:
+
+    def __init__(self, buckets: list):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # the last one is everything above the top bucket
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        i = 0
+        while i < len(self.buckets) and value > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def to_dict(self):
+        return {'buckets': self.buckets, 'counts': list(self.counts), 'sum': round(self.sum, 6), 'count': self.count}
+
+
+class Metrics:
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+        self._stop = threading.Event()
+        self._reporter = None
+        self._server = None
+
+    def reset(self):
+        """Start over, e.g. in a forked worker process that inherited the parent's numbers"""
+        with self.lock:
+            self.started = time.time()
+            self.calls: dict[str, Histogram] = {}  # 'service|method' -> latency histogram
+            self.errors = Counter()  # 'service|method|reason' -> count
+            self.retries = Counter()  # 'service|method|reason' -> count
+            self.bytes = Counter()  # 'service|sent' or 'service|received' -> bytes
+            self.counters = Counter()  # tickets_done, files_moved, copy_fallbacks, ...
+            self.tickets = Histogram(TICKET_BUCKETS)
+
+    def observe_call(self, service: str, method: str, seconds: float, error: str = None):
+        """Record one attempt at an API call, and the reason it failed, if it did"""
+        key = f'{service}{SEP}{method}'
+        with self.lock:
+            histogram = self.calls.get(key)
+            if histogram is None:
+                histogram = self.calls[key] = Histogram(LATENCY_BUCKETS)
+            histogram.observe(seconds)
+            if error:
+                self.errors[f'{key}{SEP}{error}'] += 1
+
+    def error(self, service: str, method: str, reason: str):
+        """Record a failure that didn't come with a call of its own, like one item of a batch"""
+        with self.lock:
+            self.errors[f'{service}{SEP}{method}{SEP}{reason}'] += 1
+
+    def retry(self, service: str, method: str, reason: str):
+        with self.lock:
+            self.retries[f'{service}{SEP}{method}{SEP}{reason}'] += 1
+
+    def add_bytes(self, service: str, sent: int = 0, received: int = 0):
+        with self.lock:
+            self.bytes[f'{service}{SEP}sent'] += sent
+            self.bytes[f'{service}{SEP}received'] += received
+
+    def count(self, name: str, amount: float = 1):
+        with self.lock:
+            self.counters[name] += amount
+
+    def ticket_done(self, seconds: float):
+        with self.lock:
+            self.tickets.observe(seconds)
+            self.counters['tickets_done'] += 1
+
+    def snapshot(self):
+        with self.lock:
+            return {'pid': os.getpid(), 'started': self.started, 'time': time.time(),
+                    'calls': {key: histogram.to_dict() for key, histogram in self.calls.items()},
+                    'errors': dict(self.errors), 'retries': dict(self.retries), 'bytes': dict(self.bytes),
+                    'counters': dict(self.counters), 'tickets': self.tickets.to_dict()}
+
+    def start_reporter(self, path: str, interval: float = 30, collect=None, show_progress: bool = False):
+        """
+        Write a JSON snapshot to path every `interval` seconds on a background thread, and log a progress line.
+
+        :param collect: function returning the snapshot to write, e.g. one merged with the worker processes'.
+            Defaults to this process's snapshot.
+        :param show_progress: also keep a live progress line on stderr
+        """
+        collect = collect or self.snapshot
+        self._stop.clear()
+
+        def report():
+            while not self._stop.wait(interval):
+                self.report(path, collect, show_progress)
+
+        self._reporter = threading.Thread(target=report, name='metrics-reporter', daemon=True)
+        self._reporter.start()
+
+    def report(self, path: str, collect=None, show_progress: bool = False):
+        """Write one snapshot to path and log its progress line"""
+        snap = (collect or self.snapshot)()
+        write_snapshot(snap, path)
+        line = format_progress(progress(snap))
+        logger.info(line)
+        if show_progress:
+            sys.stderr.write(f'\r{line}\033[K')
+            sys.stderr.flush()
+        return snap
+
+    def stop_reporter(self, path: str = None, collect=None, show_progress: bool = False):
+        """Stop the reporter thread, then write a last snapshot to path"""
+        self._stop.set()
+        if self._reporter is not None:
+            self._reporter.join()
+            self._reporter = None
+        if path:
+            self.report(path, collect, show_progress)
+            if show_progress:
+                sys.stderr.write('\n')
+        if self._server is not None:
+            self._server.shutdown()
+            self._server.server_close()
+            self._server = None
+
+    def serve(self, port: int, collect=None):
+        """
+        Serve Prometheus text format on http://127.0.0.1:port/metrics from a background thread
+
+        :param collect: function returning the snapshot to serve, see start_reporter
+        """
+        collect = collect or self.snapshot
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def log_message(self, *args):
+                pass
+
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                data = to_prometheus(collect()).encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4')
+                self.send_header('Content-Length', str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+        threading.Thread(target=self._server.serve_forever, name='metrics-server', daemon=True).start()
+        logger.info(f'Serving metrics on http://127.0.0.1:{self._server.server_port}/metrics')
+        return self._server.server_port
+
+
+def write_snapshot(snap: dict, path: str):
+    """Write atomically, so whoever's reading the file never sees half of it"""
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    tmp_path = f'{path}.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as outfile:
+        json.dump(obj=snap, fp=outfile)
+    os.replace(tmp_path, path)
+
+
+def read_snapshots(pattern: str):
+    """Every snapshot file matching a glob pattern; unreadable ones (say, mid-write on Windows) are skipped"""
+    snaps = []
+    for path in glob.glob(pattern):
+        try:
+            with open(path, 'r', encoding='utf-8') as infile:
+                snaps.append(json.load(infile))
+        except (OSError, ValueError):
+            continue
+    return snaps
+
+
+def _merge_histograms(a: dict, b: dict):
+    if a is None:
+        return dict(b, counts=list(b.get('counts')))
+    return {'buckets': a.get('buckets'), 'counts': [x + y for x, y in zip(a.get('counts'), b.get('counts'))],
+            'sum': a.get('sum') + b.get('sum'), 'count': a.get('count') + b.get('count')}
+
+
+def merge(snaps: list):
+    """Add up the snapshots of several processes into one"""
+    merged = {'pid': os.getpid(), 'started': min((s.get('started') for s in snaps), default=time.time()),
+              'time': time.time(), 'calls': {}, 'errors': Counter(), 'retries': Counter(), 'bytes': Counter(),
+              'counters': Counter(), 'tickets': None}
+    for snap in snaps:
+        for key, histogram in snap.get('calls', {}).items():
+            merged['calls'][key] = _merge_histograms(merged['calls'].get(key), histogram)
+        for section in ['errors', 'retries', 'bytes', 'counters']:
+            merged[section].update(snap.get(section, {}))
+        merged['tickets'] = _merge_histograms(merged['tickets'], snap.get('tickets'))
+    for section in ['errors', 'retries', 'bytes', 'counters']:
+        merged[section] = dict(merged[section])
+    merged['tickets'] = merged['tickets'] or Histogram(TICKET_BUCKETS).to_dict()
+    return merged
+
+
+def progress(snap: dict):
+    """Rates and an ETA from a snapshot. The ETA is against the tickets listed so far, so it can grow"""
+    counters = snap.get('counters', {})
+    elapsed = max(snap.get('time') - snap.get('started'), 1e-9)
+    done = counters.get('tickets_done', 0)
+    total = max(counters.get('tickets_total', 0), counters.get('tickets_found', 0), done)
+    calls = sum(histogram.get('count') for histogram in snap.get('calls', {}).values())
+    tickets_per_sec = done / elapsed
+    return {'tickets_done': done, 'tickets_total': total, 'files_moved': counters.get('files_moved', 0),
+            'items_per_sec': round(counters.get('files_moved', 0) / elapsed, 2),
+            'tickets_per_sec': round(tickets_per_sec, 3), 'calls': calls,
+            'errors': sum(snap.get('errors', {}).values()), 'retries': sum(snap.get('retries', {}).values()),
+            'copy_fallbacks': counters.get('copy_fallbacks', 0),
+            'eta_seconds': round((total - done) / tickets_per_sec) if tickets_per_sec else None,
+            'elapsed_seconds': round(elapsed)}
+
+
+def _hms(seconds):
+    if seconds is None:
+        return '?'
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f'{hours:d}:{minutes:02d}:{seconds:02d}'
+
+
+def format_progress(p: dict):
+    return (f'{p.get("tickets_done")}/{p.get("tickets_total")} tickets, {p.get("files_moved")} files '
+            f'({p.get("items_per_sec")} files/s), {p.get("calls")} calls, {p.get("retries")} retries, '
+            f'{p.get("errors")} errors, {p.get("copy_fallbacks")} copy fallbacks, '
+            f'elapsed {_hms(p.get("elapsed_seconds"))}, ETA {_hms(p.get("eta_seconds"))}')
+
+
+def _labels(**labels):
+    if not labels:
+        return ''
+    escaped = {name: str(value).replace('\\', '\\\\').replace('"', '\\"') for name, value in labels.items()}
+    return '{' + ','.join(f'{name}="{value}"' for name, value in escaped.items()) + '}'
+
+
+def _histogram_lines(name: str, histogram: dict, **labels):
+    lines = []
+    cumulative = 0
+    for bound, count in zip(histogram.get('buckets') + ['+Inf'], histogram.get('counts')):
+        cumulative += count
+        lines.append(f'{name}_bucket{_labels(**labels, le=bound)} {cumulative}')
+    lines.append(f'{name}_sum{_labels(**labels)} {histogram.get("sum")}')
+    lines.append(f'{name}_count{_labels(**labels)} {histogram.get("count")}')
+    return lines
+
+
+def to_prometheus(snap: dict):
+    """A snapshot in Prometheus text exposition format"""
+    lines = ['# TYPE migration_api_call_seconds histogram']
+    for key, histogram in sorted(snap.get('calls', {}).items()):
+        service, method = key.split(SEP, 1)
+        lines.extend(_histogram_lines('migration_api_call_seconds', histogram, service=service, method=method))
+    for section, name in [('errors', 'migration_api_errors_total'), ('retries', 'migration_api_retries_total')]:
+        lines.append(f'# TYPE {name} counter')
+        for key, count in sorted(snap.get(section, {}).items()):
+            service, method, reason = key.split(SEP, 2)
+            lines.append(f'{name}{_labels(service=service, method=method, reason=reason)} {count}')
+    lines.append('# TYPE migration_bytes_total counter')
+    for key, count in sorted(snap.get('bytes', {}).items()):
+        service, direction = key.split(SEP, 1)
+        lines.append(f'migration_bytes_total{_labels(service=service, direction=direction)} {count}')
+    lines.append('# TYPE migration_ticket_seconds histogram')
+    lines.extend(_histogram_lines('migration_ticket_seconds', snap.get('tickets')))
+    for name, value in sorted(snap.get('counters', {}).items()):
+        name = re.sub(r'[^a-zA-Z0-9_:]', '_', name)  # anything else fails the whole scrape
+        lines.append(f'# TYPE migration_{name} gauge')
+        lines.append(f'migration_{name} {value}')
+    return '\n'.join(lines) + '\n'
+
+
+metrics = Metrics()
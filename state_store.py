@@ -0,0 +1,342 @@
+import csv
+import os
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from log import logger
+
+'''
+Migration bookkeeping in a single SQLite file. Replaces the old ids.csv/done text files: lookups are indexed, every
+write is its own transaction, and several processes can share the file.
+'''
+
+# a ticket moves through these in order
+CREATED = 'created'
+FILES_MOVED = 'files_moved'
+ZENDESK_UPDATED = 'zendesk_updated'
+SOURCE_DELETED = 'source_deleted'
+STATUSES = [CREATED, FILES_MOVED, ZENDESK_UPDATED, SOURCE_DELETED]
+DONE_STATUSES = [ZENDESK_UPDATED, SOURCE_DELETED]
+# a folder inside a ticket is CREATED once its destination exists, and FOLDER_DONE once everything under it has moved
+FOLDER_DONE = 'done'
+FOLDER_STATUSES = [CREATED, FOLDER_DONE]
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS tickets (
+    old_id TEXT PRIMARY KEY,
+    new_id TEXT,
+    ticket_number TEXT,
+    name TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS tickets_new_id ON tickets (new_id);
+CREATE INDEX IF NOT EXISTS tickets_ticket_number ON tickets (ticket_number);
+CREATE TABLE IF NOT EXISTS folders (
+    old_id TEXT PRIMARY KEY,
+    new_id TEXT,
+    ticket_id TEXT,
+    status TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS folders_ticket_id ON folders (ticket_id);
+CREATE TABLE IF NOT EXISTS files (
+    old_id TEXT PRIMARY KEY,
+    new_id TEXT,
+    folder_id TEXT NOT NULL,
+    updated_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS files_folder_id ON files (folder_id);
+CREATE TABLE IF NOT EXISTS dest_folders (
+    parent_id TEXT NOT NULL,
+    name TEXT NOT NULL,
+    id TEXT NOT NULL,
+    PRIMARY KEY (parent_id, name)
+);
+CREATE TABLE IF NOT EXISTS settings (
+    key TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS post_migration (
+    old_id TEXT PRIMARY KEY,
+    ticket_number TEXT NOT NULL,
+    new_id TEXT,
+    comment INTEGER NOT NULL,
+    check_folder TEXT,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_attempt REAL NOT NULL,
+    error TEXT,
+    queued_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS post_migration_next_attempt ON post_migration (next_attempt);
+'''
+MAX_SQL_PARAMS = 500  # ids per "IN (...)" query, well under SQLite's limit
+
+
+class StateStore:
+
+    def __init__(self, path: str = 'migration.db'):
+        self.path = path
+        self._conn = None
+        self._pid = None
+        self.lock = threading.RLock()
+
+    @property
+    def conn(self):
+        """One connection per process, opened on first use, so a store created before forking stays usable"""
+        if self._conn is None or self._pid != os.getpid():
+            self._conn = sqlite3.connect(self.path, timeout=60, check_same_thread=False, isolation_level=None)
+            self._conn.row_factory = sqlite3.Row
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.executescript(SCHEMA)
+            self._pid = os.getpid()
+        return self._conn
+
+    @contextmanager
+    def transaction(self):
+        """Everything executed on the yielded connection is committed together, or not at all"""
+        with self.lock:
+            conn = self.conn
+            conn.execute('BEGIN IMMEDIATE')
+            try:
+                yield conn
+            except BaseException:
+                conn.execute('ROLLBACK')
+                raise
+            conn.execute('COMMIT')
+
+    def _write(self, sql: str, params=()):
+        with self.transaction() as conn:
+            conn.execute(sql, params)
+
+    def _one(self, sql: str, params=()):
+        with self.lock:
+            row = self.conn.execute(sql, params).fetchone()
+        return dict(row) if row else None
+
+    def record_created(self, old_id: str, new_id: str, ticket_number: str, name: str):
+        """A ticket folder has been re-created in the shared drive"""
+        self._write('INSERT INTO tickets (old_id, new_id, ticket_number, name, status, updated_at) '
+                    'VALUES (?, ?, ?, ?, ?, ?) '
+                    'ON CONFLICT (old_id) DO UPDATE SET new_id = excluded.new_id, '
+                    'ticket_number = excluded.ticket_number, name = excluded.name, updated_at = excluded.updated_at',
+                    (old_id, new_id, ticket_number, name, CREATED, time.time()))
+
+    def set_status(self, old_id: str, status: str):
+        if status not in STATUSES:
+            raise ValueError(f'Unknown ticket status {status}')
+        self._write('UPDATE tickets SET status = ?, updated_at = ? WHERE old_id = ?', (status, time.time(), old_id))
+
+    def set_statuses(self, old_ids: list, status: str):
+        """set_status for many tickets in one transaction"""
+        if status not in STATUSES:
+            raise ValueError(f'Unknown ticket status {status}')
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('UPDATE tickets SET status = ?, updated_at = ? WHERE old_id = ?',
+                             [(status, now, old_id) for old_id in old_ids])
+
+    def get(self, old_id: str):
+        return self._one('SELECT * FROM tickets WHERE old_id = ?', (old_id,))
+
+    def get_by_new_id(self, new_id: str):
+        return self._one('SELECT * FROM tickets WHERE new_id = ?', (new_id,))
+
+    def get_by_ticket_number(self, ticket_number: str):
+        return self._one('SELECT * FROM tickets WHERE ticket_number = ?', (ticket_number,))
+
+    def is_done(self, old_id: str):
+        row = self.get(old_id)
+        return row is not None and row.get('status') in DONE_STATUSES
+
+    def tickets(self, status: str = None):
+        """All ticket rows, optionally only those with a given status"""
+        with self.lock:
+            if status:
+                rows = self.conn.execute('SELECT * FROM tickets WHERE status = ?', (status,)).fetchall()
+            else:
+                rows = self.conn.execute('SELECT * FROM tickets').fetchall()
+        return [dict(row) for row in rows]
+
+    def record_folder(self, old_id: str, new_id: str, ticket_id: str):
+        """A folder inside a ticket has been re-created (or found) in the shared drive as new_id"""
+        self._write('INSERT INTO folders (old_id, new_id, ticket_id, status, updated_at) VALUES (?, ?, ?, ?, ?) '
+                    'ON CONFLICT (old_id) DO UPDATE SET new_id = excluded.new_id, updated_at = excluded.updated_at',
+                    (old_id, new_id, ticket_id, CREATED, time.time()))
+
+    def set_folder_status(self, old_id: str, status: str):
+        if status not in FOLDER_STATUSES:
+            raise ValueError(f'Unknown folder status {status}')
+        self._write('UPDATE folders SET status = ?, updated_at = ? WHERE old_id = ?', (status, time.time(), old_id))
+
+    def set_folders_status(self, old_ids: list, status: str):
+        """set_folder_status for many folders in one transaction"""
+        if status not in FOLDER_STATUSES:
+            raise ValueError(f'Unknown folder status {status}')
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('UPDATE folders SET status = ?, updated_at = ? WHERE old_id = ?',
+                             [(status, now, old_id) for old_id in old_ids])
+
+    def get_folder(self, old_id: str):
+        return self._one('SELECT * FROM folders WHERE old_id = ?', (old_id,))
+
+    def get_folders(self, old_ids: list):
+        """:return: {old id: folder row} for the ones the store knows about"""
+        rows = []
+        with self.lock:
+            for i in range(0, len(old_ids), MAX_SQL_PARAMS):
+                chunk = old_ids[i:i + MAX_SQL_PARAMS]
+                rows.extend(self.conn.execute(f'SELECT * FROM folders WHERE old_id IN ({",".join("?" * len(chunk))})',
+                                              chunk).fetchall())
+        return {row['old_id']: dict(row) for row in rows}
+
+    def record_files(self, folder_id: str, moved: dict):
+        """
+        :param folder_id: source folder the files were moved out of
+        :param moved: {old file id: id it ended up as}. That's the same id for a move, the copy's id for a copy
+            fallback, and None for a file that had to stay behind.
+        """
+        if not moved:
+            return
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO files (old_id, new_id, folder_id, updated_at) VALUES (?, ?, ?, ?)',
+                             [(old_id, new_id, folder_id, now) for old_id, new_id in moved.items()])
+
+    def moved_files(self, folder_id: str):
+        """ids of the files already dealt with in a source folder. Copied and trashed ones are still in it."""
+        with self.lock:
+            rows = self.conn.execute('SELECT old_id FROM files WHERE folder_id = ?', (folder_id,)).fetchall()
+        return {row['old_id'] for row in rows}
+
+    def ticket_folders(self, ticket_id: str):
+        """:return: {old id: new id} of every folder recorded inside a ticket"""
+        with self.lock:
+            rows = self.conn.execute('SELECT old_id, new_id FROM folders WHERE ticket_id = ?', (ticket_id,)).fetchall()
+        return {row['old_id']: row['new_id'] for row in rows}
+
+    def ticket_files(self, ticket_id: str):
+        """:return: {old id: (new id, source folder id)} of every file recorded in a ticket, loose ones included"""
+        with self.lock:
+            rows = self.conn.execute('SELECT old_id, new_id, folder_id FROM files WHERE folder_id = ? '
+                                     'OR folder_id IN (SELECT old_id FROM folders WHERE ticket_id = ?)',
+                                     (ticket_id, ticket_id)).fetchall()
+        return {row['old_id']: (row['new_id'], row['folder_id']) for row in rows}
+
+    def cache_dest_folders(self, parent_id: str, folders: dict):
+        """:param folders: {name: id} of folders that exist under parent_id in the shared drive"""
+        if not folders:
+            return
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR REPLACE INTO dest_folders (parent_id, name, id) VALUES (?, ?, ?)',
+                             [(parent_id, name, folder_id) for name, folder_id in folders.items()])
+
+    def dest_folders(self, parent_id: str):
+        """:return: {name: id} of the folders cached under parent_id"""
+        with self.lock:
+            rows = self.conn.execute('SELECT name, id FROM dest_folders WHERE parent_id = ?', (parent_id,)).fetchall()
+        return {row['name']: row['id'] for row in rows}
+
+    def get_setting(self, key: str, default: str = None):
+        row = self._one('SELECT value FROM settings WHERE key = ?', (key,))
+        return row.get('value') if row else default
+
+    def set_setting(self, key: str, value: str):
+        self._write('INSERT OR REPLACE INTO settings (key, value) VALUES (?, ?)', (key, value))
+
+    def queue_post_migration(self, old_id: str, ticket_number: str, new_id: str, comment: bool,
+                             check_folder: str = None):
+        """
+        A ticket's files have all been moved: mark it FILES_MOVED and queue its Zendesk update and source deletion, in
+        the same transaction. Queuing a ticket that's already queued keeps its place and retry count.
+
+        :param comment: whether its Zendesk update gets the moved-files comment
+        :param check_folder: comment if this destination folder turns out not to be empty, even if comment is False
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            conn.execute('UPDATE tickets SET status = ?, updated_at = ? WHERE old_id = ? AND status = ?',
+                         (FILES_MOVED, now, old_id, CREATED))
+            conn.execute('INSERT INTO post_migration (old_id, ticket_number, new_id, comment, check_folder, '
+                         'next_attempt, queued_at) VALUES (?, ?, ?, ?, ?, ?, ?) '
+                         'ON CONFLICT (old_id) DO UPDATE SET ticket_number = excluded.ticket_number, '
+                         'new_id = excluded.new_id, comment = excluded.comment, check_folder = excluded.check_folder',
+                         (old_id, str(ticket_number), new_id, int(bool(comment)), check_folder, now, now))
+
+    def get_post_migration(self, old_id: str):
+        return self._one('SELECT * FROM post_migration WHERE old_id = ?', (old_id,))
+
+    def post_migration_due(self):
+        """:return: (number of queued tickets due now, when the longest-waiting of them was queued)"""
+        row = self._one('SELECT COUNT(*) AS due, MIN(queued_at) AS oldest FROM post_migration WHERE next_attempt <= ?',
+                        (time.time(),))
+        return row.get('due'), row.get('oldest')
+
+    def post_migration_count(self):
+        return self._one('SELECT COUNT(*) AS queued FROM post_migration').get('queued')
+
+    def claim_post_migration(self, limit: int, lease: float):
+        """
+        Take up to limit due tickets off the front of the queue. They aren't due again for `lease` seconds, so another
+        process working the same queue leaves them alone; finish or retry them before then.
+        """
+        now = time.time()
+        with self.transaction() as conn:
+            rows = conn.execute('SELECT * FROM post_migration WHERE next_attempt <= ? ORDER BY queued_at LIMIT ?',
+                                (now, limit)).fetchall()
+            conn.executemany('UPDATE post_migration SET next_attempt = ? WHERE old_id = ?',
+                             [(now + lease, row['old_id']) for row in rows])
+        return [dict(row) for row in rows]
+
+    def retry_post_migration(self, delays: dict, error: str):
+        """:param delays: {old id: seconds before that ticket is due again}"""
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('UPDATE post_migration SET attempts = attempts + 1, next_attempt = ?, error = ? '
+                             'WHERE old_id = ?', [(now + delay, error, old_id) for old_id, delay in delays.items()])
+
+    def finish_post_migration(self, old_ids: list, status: str = None):
+        """Take tickets off the post-migration queue, moving them to status if there is one"""
+        if status is not None and status not in STATUSES:
+            raise ValueError(f'Unknown ticket status {status}')
+        now = time.time()
+        with self.transaction() as conn:
+            conn.executemany('DELETE FROM post_migration WHERE old_id = ?', [(old_id,) for old_id in old_ids])
+            if status is not None:
+                conn.executemany('UPDATE tickets SET status = ?, updated_at = ? WHERE old_id = ?',
+                                 [(status, now, old_id) for old_id in old_ids])
+
+    def import_legacy(self, idcsv: str = 'ids.csv', done: str = 'done'):
+        """
+        Load the ids.csv/done files written by older versions of the migrator. Rows already in the store are left
+        alone, so this is safe to run every time.
+        """
+        now = time.time()
+        rows = {}
+        if os.path.exists(idcsv):
+            with open(idcsv, 'r', encoding='utf-8', newline='') as inf:
+                for line in csv.reader(inf):
+                    if len(line) >= 3:
+                        old_id, new_id, name = line[0], line[1], line[2]
+                        try:
+                            ticket_number = name.split('#')[1].split()[0]
+                        except IndexError:
+                            ticket_number = None
+                        rows[old_id] = [old_id, new_id, ticket_number, name, CREATED, now]
+        if os.path.exists(done):
+            with open(done, 'r', encoding='utf-8') as inf:
+                for old_id in inf.read().splitlines():
+                    if old_id in rows:
+                        rows[old_id][4] = ZENDESK_UPDATED
+                    elif old_id:
+                        rows[old_id] = [old_id, None, None, None, ZENDESK_UPDATED, now]
+        if not rows:
+            return
+        with self.transaction() as conn:
+            conn.executemany('INSERT OR IGNORE INTO tickets (old_id, new_id, ticket_number, name, status, updated_at) '
+                             'VALUES (?, ?, ?, ?, ?, ?)', list(rows.values()))
+        logger.info(f'Imported {len(rows)} tickets from {idcsv} and {done}')
@@ -0,0 +1,213 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+
+import requests
+from googleapiclient.errors import HttpError
+from log import logger
+from metrics import metrics
+
+'''
+Shared throttling for everything that talks to Google or Zendesk: a token bucket to stay under quota, plus retries
+with jittered exponential backoff (honoring Retry-After) for rate limit errors, 5xx's and timeouts.
+'''
+
+DRIVE_RATE = 150  # requests/second. Drive allows 12,000 queries per minute per user
+ZENDESK_RATE = 700 / 60  # requests/second. Zendesk Enterprise allows 700 requests per minute
+COPY_RATE = 10  # requests/second for copy fallbacks, on top of DRIVE_RATE. Copies are the slowest, heaviest writes
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+RATE_LIMIT_REASONS = ['userRateLimitExceeded', 'rateLimitExceeded']
+
+
+def _parse_retry_after(value):
+    """Retry-After is either a number of seconds or an HTTP date"""
+    if not value:
+        return None
+    try:
+        return max(float(value), 0.0)
+    except ValueError:
+        pass
+    try:
+        return max(parsedate_to_datetime(value).timestamp() - time.time(), 0.0)
+    except (TypeError, ValueError):
+        return None
+
+
+def is_rate_limit_error(error: HttpError):
+    details = error.error_details if isinstance(error.error_details, list) else []
+    reasons = [detail.get('reason') for detail in details if isinstance(detail, dict)]
+    return error.resp.status == 429 or (error.resp.status == 403 and any(r in RATE_LIMIT_REASONS for r in reasons))
+
+
+def classify(outcome):
+    """
+    Decide whether a call should be retried.
+
+    :param outcome: an exception raised by the call, or the requests.Response it returned
+    :return: (retry, retry_after, throttled) where retry_after is the server's requested delay in seconds, if any,
+        and throttled means the server told us to slow down
+    """
+    if isinstance(outcome, HttpError):
+        retry_after = _parse_retry_after(outcome.resp.get('retry-after'))
+        if is_rate_limit_error(outcome):
+            return True, retry_after, True
+        return outcome.resp.status in RETRY_STATUSES, retry_after, False
+    if isinstance(outcome, requests.Response):
+        retry_after = _parse_retry_after(outcome.headers.get('Retry-After'))
+        return outcome.status_code in RETRY_STATUSES, retry_after, outcome.status_code == 429
+    if isinstance(outcome, (TimeoutError, ConnectionError, requests.exceptions.Timeout,
+                            requests.exceptions.ConnectionError)):
+        return True, None, False
+    return False, None, False
+
+
+def is_ambiguous(outcome):
+    """Whether a failed call may have been carried out anyway: a 5xx or a timeout, but not a rate limit error"""
+    retry, _, throttled = classify(outcome)
+    return retry and not throttled
+
+
+def reason_of(outcome):
+    """Short name for why a call failed, for metrics: the Google error reason, the HTTP status or the exception type"""
+    if isinstance(outcome, HttpError):
+        details = outcome.error_details if isinstance(outcome.error_details, list) else []
+        reasons = [detail.get('reason') for detail in details if isinstance(detail, dict) and detail.get('reason')]
+        return reasons[0] if reasons else str(outcome.resp.status)
+    if isinstance(outcome, requests.Response):
+        return str(outcome.status_code)
+    return type(outcome).__name__
+
+
+class TokenBucket:
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        :param rate: tokens added per second
+        :param capacity: most tokens the bucket can hold, i.e. the largest burst; defaults to one second's worth
+        """
+        self.rate = rate
+        self.capacity = capacity or max(rate, 1)
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: float = 1):
+        """Block until `tokens` are available and take them. Returns the number of seconds spent waiting."""
+        tokens = min(tokens, self.capacity)
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return waited
+                delay = (tokens - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+
+class Throttle:
+
+    def __init__(self, name: str, rate: float, max_retries: int = 8, base_delay: float = 1.0, max_delay: float = 64.0):
+        """
+        :param name: used in log messages
+        :param rate: most requests per second we aim for. The effective rate is halved whenever the server pushes
+            back, then creeps back up towards this after successful calls.
+        :param max_retries: give up and re-raise after this many retries of a single call
+        :param base_delay: first backoff delay in seconds, doubled for every retry
+        :param max_delay: cap on a single backoff delay in seconds
+        """
+        self.name = name
+        self.max_rate = rate
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(rate)
+        self.lock = threading.Lock()
+        self.calls = 0
+        self.retries = 0
+        self.throttled_seconds = 0.0
+
+    def set_rate(self, rate: float):
+        """Change the target rate, e.g. to split a quota between worker processes"""
+        self.max_rate = rate
+        self.bucket = TokenBucket(rate)
+
+    def stats(self):
+        with self.lock:
+            return {'calls': self.calls, 'retries': self.retries, 'throttled_seconds': round(self.throttled_seconds, 3),
+                    'rate': round(self.bucket.rate, 3)}
+
+    def _record_wait(self, seconds: float):
+        if seconds:
+            with self.lock:
+                self.throttled_seconds += seconds
+            metrics.count(f'{self.name}_throttled_seconds', seconds)
+
+    def backed_off(self):
+        """The server told us to slow down: halve the rate"""
+        with self.bucket.lock:
+            self.bucket.rate = max(self.bucket.rate / 2, self.max_rate / 64)
+
+    def _succeeded(self):
+        with self.bucket.lock:
+            if self.bucket.rate < self.max_rate:
+                self.bucket.rate = min(self.max_rate, self.bucket.rate + self.max_rate / 100)
+
+    def backoff_delay(self, attempt: int, retry_after: float = None):
+        if retry_after is not None:
+            return retry_after
+        return min(self.max_delay, self.base_delay * 2 ** attempt) * random.uniform(0.5, 1.5)
+
+    def call(self, fn, *args, cost: float = 1, label: str = 'call', idempotent: bool = True, **kwargs):
+        """
+        Call fn(*args, **kwargs) within the rate limit, retrying rate limit errors, 5xx's and timeouts.
+
+        :param cost: number of requests this call counts as against the quota, e.g. the size of a batch
+        :param label: what the call is, e.g. 'files.list', for the latency/error/retry metrics
+        :param idempotent: False for calls that mustn't happen twice, like creating a file. Those are only retried
+            after rate limit errors; a 5xx or a timeout may come after the server did the work, so it's raised.
+        :return: whatever fn returns. A requests.Response with a retryable status is returned as-is once the retries
+            run out.
+        """
+        attempt = 0
+        while True:
+            self._record_wait(self.bucket.acquire(cost))
+            with self.lock:
+                self.calls += 1
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                metrics.observe_call(self.name, label, time.monotonic() - start, error=reason_of(e))
+                retry, retry_after, throttled = classify(e)
+                if not retry or attempt >= self.max_retries or not (idempotent or throttled):
+                    raise
+                outcome, reason = e, reason_of(e)
+            else:
+                retry, retry_after, throttled = classify(result)
+                reason = reason_of(result) if retry or getattr(result, 'ok', True) is False else None
+                metrics.observe_call(self.name, label, time.monotonic() - start, error=reason)
+                if not retry or attempt >= self.max_retries or not (idempotent or throttled):
+                    self._succeeded()
+                    return result
+                outcome = f'HTTP {result.status_code}'
+
+            if throttled:
+                self.backed_off()
+            delay = self.backoff_delay(attempt, retry_after)
+            attempt += 1
+            with self.lock:
+                self.retries += 1
+            metrics.retry(self.name, label, reason)
+            logger.warning(f'{self.name}: retry {attempt}/{self.max_retries} in {delay:.1f}s after {outcome}')
+            time.sleep(delay)
+            self._record_wait(delay)
+
+
+drive_throttle = Throttle('drive', rate=DRIVE_RATE)
+copy_throttle = Throttle('drive_copy', rate=COPY_RATE)
+zendesk_throttle = Throttle('zendesk', rate=ZENDESK_RATE)
@@ -0,0 +1,94 @@
+import json
+
+'''
+An in-memory copy of everything under a Drive folder, indexed by parent, so the migrator can plan its work without a
+listing call per folder. Build one with DriveClient.snapshot_tree.
+'''
+
+FOLDER_MIMETYPE = 'application/vnd.google-apps.folder'
+DIFF_FIELDS = ['name', 'parents', 'md5Checksum', 'modifiedTime']
+
+
+class TreeSnapshot:
+
+    def __init__(self, root_id: str):
+        self.root_id = root_id
+        self.items: dict[str, dict] = {}  # id -> file dict as returned by files().list
+        self.children: dict[str, list[str]] = {}  # parent id -> child ids
+        self.start_page_token = None  # Drive changes feed position from just before the snapshot was taken
+
+    def __len__(self):
+        return len(self.items)
+
+    def __contains__(self, file_id: str):
+        return file_id in self.items
+
+    def add(self, item: dict):
+        """:return: False if the item was already in the snapshot"""
+        file_id = item.get('id')
+        if file_id in self.items:
+            return False
+        self.items[file_id] = item
+        for parent in item.get('parents', []):
+            self.children.setdefault(parent, []).append(file_id)
+        return True
+
+    def get(self, file_id: str):
+        return self.items.get(file_id)
+
+    def parent_of(self, file_id: str):
+        item = self.items.get(file_id)
+        return (item.get('parents') or [None])[0] if item else None
+
+    def path(self, file_id: str):
+        """'a/b/name' of an item, relative to the root"""
+        names = []
+        while file_id and file_id != self.root_id and file_id in self.items and len(names) <= len(self.items):
+            names.append(self.items[file_id].get('name'))
+            file_id = self.parent_of(file_id)
+        return '/'.join(reversed(names))
+
+    def children_of(self, folder_id: str, folders_only: bool = False):
+        """Same as listing the folder: a list of file dicts"""
+        children = [self.items[child_id] for child_id in self.children.get(folder_id, [])]
+        if folders_only:
+            return [child for child in children if child.get('mimeType') == FOLDER_MIMETYPE]
+        return children
+
+    def walk(self, folder_id: str = None):
+        """Yield every item under folder_id (default: the root), parents before their children"""
+        queue = [folder_id or self.root_id]
+        while queue:
+            for child in self.children_of(queue.pop()):
+                yield child
+                if child.get('mimeType') == FOLDER_MIMETYPE:
+                    queue.append(child.get('id'))
+
+    def diff(self, later: 'TreeSnapshot'):
+        """
+        Compare this snapshot against a later one of the same tree.
+
+        :return: {'added': [...], 'removed': [...], 'changed': [...]}, each a list of file dicts (from the later
+            snapshot for added and changed, from this one for removed)
+        """
+        added = [item for file_id, item in later.items.items() if file_id not in self.items]
+        removed = [item for file_id, item in self.items.items() if file_id not in later.items]
+        changed = [item for file_id, item in later.items.items()
+                   if file_id in self.items
+                   and any(self.items[file_id].get(field) != item.get(field) for field in DIFF_FIELDS)]
+        return {'added': added, 'removed': removed, 'changed': changed}
+
+    def save(self, path: str):
+        with open(path, 'w', encoding='utf-8') as outfile:
+            json.dump(obj={'root_id': self.root_id, 'start_page_token': self.start_page_token,
+                           'items': list(self.items.values())}, fp=outfile)
+
+    @classmethod
+    def load(cls, path: str):
+        with open(path, 'r', encoding='utf-8') as infile:
+            data = json.load(infile)
+        snapshot = cls(data.get('root_id'))
+        snapshot.start_page_token = data.get('start_page_token')
+        for item in data.get('items'):
+            snapshot.add(item)
+        return snapshot
@@ -6,3 +6,5 @@ zendesk_tickets_ep = 'tickets'
 zendesk_users_ep = 'users'
 zendesk_ticket_fields_ep = 'ticket_fields'
 default_permissionid = 'Google Drive API permission ID'
+F_Redacted = 'ID of the old shared folder holding the ticket folders'
+F_TEAM_DRIVE_Redacted = 'ID of the shared drive the ticket folders move to'
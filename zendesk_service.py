@@ -1,33 +1,145 @@
 import ast
 import json
 import os
+import re
+import threading
 import requests
 import variables
+from log import logger
+from metrics import metrics
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from throttle import zendesk_throttle
 
 HEADERS = {'content-type': 'application/json'}
 TICKETS_EP = f'{variables.zendesk_url}/{variables.zendesk_tickets_ep}'
 USERS_EP = f'{variables.zendesk_url}/{variables.zendesk_users_ep}'
 AUTH = HTTPBasicAuth(variables.zendesk_user, variables.zendesk_token)
+UPDATE_MANY_LIMIT = 100  # https://developer.zendesk.com/api-reference/ticketing/tickets/tickets/#update-many-tickets
+
+
+class ZendeskClient:
+
+    def __init__(self, auth=AUTH, base_url: str = variables.zendesk_url, pool_size: int = 10,
+                 batch_size: int = UPDATE_MANY_LIMIT):
+        """
+        Holds one pooled, keep-alive session for all calls, and queues ticket updates so they can go out through
+        tickets/update_many instead of one PUT per ticket.
+
+        :param auth: requests auth for the session
+        :param base_url: API root, e.g. https://subdomain.zendesk.com/api/v2
+        :param pool_size: connections to keep open
+        :param batch_size: tickets per update_many call
+        """
+        self.session = requests.Session()
+        self.session.auth = auth
+        self.session.headers.update(HEADERS)
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+        self.base_url = base_url
+        self.tickets_ep = f'{base_url}/{variables.zendesk_tickets_ep}'
+        self.batch_size = batch_size
+        self._ticket_fields = None
+        self.pending: dict[str, dict] = {}  # ticket id -> queued update
+        self.lock = threading.Lock()
+
+    def request(self, method: str, url: str, **kwargs):
+        """Every Zendesk call goes through here, so it's rate limited and retried on 429 (honoring Retry-After)"""
+        r = zendesk_throttle.call(self.session.request, method, url, label=self._label(method, url), **kwargs)
+        metrics.add_bytes('zendesk', sent=len(kwargs.get('data') or ''), received=len(r.content or b''))
+        return r
+
+    def _label(self, method: str, url: str):
+        """'PUT https://x.zendesk.com/api/v2/tickets/123.json' -> 'PUT tickets/{id}.json', for the metrics"""
+        path = url.split('?')[0].replace(self.base_url, '').replace(variables.zendesk_url, '').strip('/')
+        return f'{method} {re.sub(r"/[0-9]+", "/{id}", path)}'
+
+    def ticket_fields(self):
+        """{field title: field id}, read from the zd_ticket_fields cache file (or Zendesk) once per process"""
+        if self._ticket_fields is None:
+            if not os.path.exists('zd_ticket_fields'):
+                r = self.request('GET', f'{self.base_url}/{variables.zendesk_ticket_fields_ep}')
+                fields = {item.get('title'): item.get('id') for item in r.json().get('ticket_fields')}
+                with open('zd_ticket_fields', 'w') as outf:
+                    outf.write(str(fields))
+            with open('zd_ticket_fields', 'r') as inf:
+                self._ticket_fields = ast.literal_eval(inf.read())
+        return self._ticket_fields
+
+    def field_id(self, field_name: str):
+        return self.ticket_fields().get(field_name)
+
+    def _queued(self, ticket_id: str):
+        return self.pending.setdefault(str(ticket_id), {'id': int(ticket_id)})
+
+    def queue_custom_field(self, ticket_id: str, value: str, field_id: str = None, field_name: str = None):
+        """Same as update_custom_field, but sent with the next flush"""
+        if not field_id and not field_name:
+            raise Exception('You must provide either a field ID or a field name to queue_custom_field!')
+        if field_name:
+            field_id = self.field_id(field_name)
+        with self.lock:
+            self._queued(ticket_id).setdefault('custom_fields', []).append({'id': field_id, 'value': value})
+
+    def queue_internal_comment(self, ticket_id: str, comment: str, user_id: str):
+        """Same as internal_comment_on_ticket, but sent with the next flush"""
+        with self.lock:
+            if 'comment' in self.pending.get(str(ticket_id), {}):
+                raise Exception(f'Ticket {ticket_id} already has a comment queued; flush before adding another')
+            self._queued(ticket_id)['comment'] = {'body': comment, 'author_id': user_id, 'public': False}
+
+    def discard(self):
+        """Drop every queued update, e.g. ones that failed to flush and will be queued again later"""
+        with self.lock:
+            self.pending = {}
+
+    @property
+    def full(self):
+        return len(self.pending) >= self.batch_size
+
+    def flush(self):
+        """
+        Send all queued ticket updates, batch_size tickets per update_many call.
+
+        :return: ids of the tickets that were sent. Zendesk applies them in a background job.
+        """
+        with self.lock:
+            queued, self.pending = list(self.pending.values()), {}
+        flushed = []
+        for i in range(0, len(queued), self.batch_size):
+            chunk = queued[i:i + self.batch_size]
+            r = self.request('PUT', f'{self.tickets_ep}/update_many.json', data=json.dumps({'tickets': chunk}))
+            if not r.ok:
+                with self.lock:
+                    for update in queued[i:]:
+                        self.pending.setdefault(str(update.get('id')), update)
+                raise Exception(f'Zendesk update_many failed with {r.status_code}: {r.text}')
+            job_id = r.json().get('job_status', {}).get('id')
+            logger.info(f'Sent updates for {len(chunk)} tickets to Zendesk (job {job_id})')
+            flushed.extend(str(update.get('id')) for update in chunk)
+        return flushed
+
+
+client = ZendeskClient()
+
+
+def _request(method: str, url: str, **kwargs):
+    return client.request(method, url, **kwargs)
 
 
 def cache_ticket_fields():
-    if not os.path.exists('zd_ticket_fields'):
-        fields_raw = get_ticket_fields()
-        fields_json = json.loads(fields_raw)
-        fields = {item.get('title'): item.get('id') for item in fields_json.get('ticket_fields')}
-        with open('zd_ticket_fields', 'w') as outf:
-            outf.write(str(fields))
+    client.ticket_fields()
 
 
 def get_ticket(ticket_id: str):
     url = f'{TICKETS_EP}/{ticket_id}.json'
-    return requests.get(url, auth=AUTH).text
+    return _request('GET', url).text
 
 
 def get_ticket_fields():
     url = f'{variables.zendesk_url}/{variables.zendesk_ticket_fields_ep}'
-    return requests.get(url, auth=AUTH).text
+    return _request('GET', url).text
 
 
 def internal_comment_on_ticket(ticket_id: str, comment: str, user_id: str):
@@ -38,7 +150,7 @@ def internal_comment_on_ticket(ticket_id: str, comment: str, user_id: str):
     :return: result
     """
     data = {"ticket": {"comment": {"body": comment, "author_id": user_id, "public": False}}}
-    return requests.put(f'{TICKETS_EP}/{ticket_id}.json', auth=AUTH, data=json.dumps(data), headers=HEADERS).text
+    return _request('PUT', f'{TICKETS_EP}/{ticket_id}.json', data=json.dumps(data), headers=HEADERS).text
 
 
 def find_user(query: str):
@@ -46,7 +158,7 @@ def find_user(query: str):
     :param query: query, e.g. "aerin"
     :return: result
     """
-    return requests.get(f'{USERS_EP}/search', params={'query': query}, auth=AUTH, headers=HEADERS)
+    return _request('GET', f'{USERS_EP}/search', params={'query': query}, headers=HEADERS)
 
 
 def update_custom_field(ticket_id: str, value: str, field_id: str = None, field_name: str = None):
@@ -62,14 +174,10 @@ def update_custom_field(ticket_id: str, value: str, field_id: str = None, field_
     if not field_id and not field_name:
         raise Exception('You must provide either a field ID or a field name to update_custom_field!')
     if field_name:
-        cache_ticket_fields()
-        with open('zd_ticket_fields', 'r') as inf:
-            fields = ast.literal_eval(inf.read())
-            id_from_name = fields.get(field_name)
-        data = {'ticket': {'custom_fields': [{'id': id_from_name, 'value': value}]}}
+        data = {'ticket': {'custom_fields': [{'id': client.field_id(field_name), 'value': value}]}}
     else:
         data = {'ticket': {'custom_fields': [{'id': field_id, 'value': value}]}}
-    return requests.put(f'{TICKETS_EP}/{ticket_id}.json', auth=AUTH, data=json.dumps(data), headers=HEADERS).text
+    return _request('PUT', f'{TICKETS_EP}/{ticket_id}.json', data=json.dumps(data), headers=HEADERS).text
 
 
 def update_custom_fields(ticket_id: str, updates: list):
@@ -79,4 +187,4 @@ def update_custom_fields(ticket_id: str, updates: list):
     :return: result
     """
     data = {'ticket': {'custom_fields': updates}}
-    return requests.put(f'{TICKETS_EP}/{ticket_id}.json', auth=AUTH, data=json.dumps(data), headers=HEADERS).text
+    return _request('PUT', f'{TICKETS_EP}/{ticket_id}.json', data=json.dumps(data), headers=HEADERS).text